@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/5.1/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
+import json
 import os
 from pathlib import Path
 from dotenv import load_dotenv
@@ -149,6 +150,75 @@ EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', True) == 'False'
 EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL', False) == 'True'
+EMAIL_CONNECTION_MAX_MESSAGES = int(os.getenv('EMAIL_CONNECTION_MAX_MESSAGES') or 100)
+# письмо без подстановок отправляется одной транзакцией (один DATA) сразу EMAIL_ENVELOPE_SIZE получателям,
+# их адреса есть только в конверте, в заголовке To - undisclosed-recipients; 1 - каждому получателю отдельно
+EMAIL_ENVELOPE_SIZE = int(os.getenv('EMAIL_ENVELOPE_SIZE') or 50)
+# подпись писем DKIM: домен подписи, селектор DNS-записи с открытым ключом и путь к закрытому ключу в формате PEM,
+# без домена или ключа письма не подписываются
+DKIM_DOMAIN = os.getenv('DKIM_DOMAIN')
+DKIM_SELECTOR = os.getenv('DKIM_SELECTOR') or 'default'
+DKIM_PRIVATE_KEY = os.getenv('DKIM_PRIVATE_KEY')
+# после SMTP_BREAKER_THRESHOLD сбоев подряд отправка на SMTP-сервер приостанавливается на SMTP_BREAKER_TIMEOUT
+# секунд, при каждом следующем неудачном пробном письме пауза удваивается, но не больше SMTP_BREAKER_MAX_TIMEOUT
+SMTP_BREAKER_THRESHOLD = int(os.getenv('SMTP_BREAKER_THRESHOLD') or 5)
+SMTP_BREAKER_TIMEOUT = int(os.getenv('SMTP_BREAKER_TIMEOUT') or 30)
+SMTP_BREAKER_MAX_TIMEOUT = int(os.getenv('SMTP_BREAKER_MAX_TIMEOUT') or 900)
+# несколько SMTP-серверов в формате JSON: [{"host": ..., "port": ..., "username": ..., "password": ...,
+# "use_tls": ..., "use_ssl": ..., "weight": ..., "concurrency": ..., "name": ...}], без него - сервер EMAIL_HOST;
+# weighted - взвешенный round-robin, least - сервер с наименьшим числом текущих отправок
+EMAIL_RELAYS = json.loads(os.getenv('EMAIL_RELAYS') or '[]')
+EMAIL_RELAY_BALANCING = os.getenv('EMAIL_RELAY_BALANCING') or 'weighted'
+
+# threads - пул потоков, async - асинхронная отправка через aiosmtplib,
+# outbox - постановка в исходящую очередь, которую разбирает команда runsender
+DISPATCH_MODE = os.getenv('DISPATCH_MODE') or 'threads'
+DISPATCH_ASYNC_IN_FLIGHT = int(os.getenv('DISPATCH_ASYNC_IN_FLIGHT') or 100)
+DISPATCH_POOL_SIZE = int(os.getenv('DISPATCH_POOL_SIZE') or 4)
+# соединений с одним SMTP-сервером, если для сервера в EMAIL_RELAYS не задано concurrency
+DISPATCH_HOST_CONCURRENCY = int(os.getenv('DISPATCH_HOST_CONCURRENCY') or 4)
+DISPATCH_BATCH_SIZE = int(os.getenv('DISPATCH_BATCH_SIZE') or 500)
+# окно распределения отправки в минутах (0 - все письма сразу), even - равномерно,
+# hash - по хешу клиента (только для DISPATCH_MODE=outbox, в остальных режимах - равномерно)
+DISPATCH_SPREAD_WINDOW = int(os.getenv('DISPATCH_SPREAD_WINDOW') or 0)
+DISPATCH_SPREAD_MODE = os.getenv('DISPATCH_SPREAD_MODE') or 'even'
+DISPATCH_CLAIM_LIMIT = int(os.getenv('DISPATCH_CLAIM_LIMIT') or 100)
+DISPATCH_LEASE_SECONDS = int(os.getenv('DISPATCH_LEASE_SECONDS') or 300)
+
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE') or 200)
+OUTBOX_LEASE_SECONDS = int(os.getenv('OUTBOX_LEASE_SECONDS') or 300)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS') or 5)
+OUTBOX_RETRY_BASE = int(os.getenv('OUTBOX_RETRY_BASE') or 60)
+OUTBOX_RETRY_MAX = int(os.getenv('OUTBOX_RETRY_MAX') or 3600)
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL') or 5)
+
+# cron - запуск рассылки раз в минуту, event - к ближайшему времени отправки
+SCHEDULER_MODE = os.getenv('SCHEDULER_MODE') or 'cron'
+NEXT_FIRE_RETRY_INTERVAL = int(os.getenv('NEXT_FIRE_RETRY_INTERVAL') or 60)
+NEXT_FIRE_RESYNC_INTERVAL = int(os.getenv('NEXT_FIRE_RESYNC_INTERVAL') or 600)
+# несколько процессов runscheduler: рассылки запускает только лидер (advisory-блокировка PostgreSQL),
+# лидер проверяет блокировку раз в SCHEDULER_LEADER_HEARTBEAT секунд, зависший лидер теряет ее
+# через SCHEDULER_LEADER_TIMEOUT секунд
+SCHEDULER_LEADER_ELECTION = os.getenv('SCHEDULER_LEADER_ELECTION', False) == 'True'
+SCHEDULER_LEADER_HEARTBEAT = int(os.getenv('SCHEDULER_LEADER_HEARTBEAT') or 2)
+SCHEDULER_LEADER_TIMEOUT = int(os.getenv('SCHEDULER_LEADER_TIMEOUT') or 10)
+
+# coalesce - пропущенные отправки объединяются в одну, skip - отправки старше MAILING_CATCHUP_GRACE секунд пропускаются
+MAILING_CATCHUP_POLICY = os.getenv('MAILING_CATCHUP_POLICY') or 'coalesce'
+MAILING_CATCHUP_GRACE = int(os.getenv('MAILING_CATCHUP_GRACE') or 3600)
+
+# разобранных шаблонов писем с подстановками в кеше процесса
+MESSAGE_TEMPLATE_CACHE_SIZE = int(os.getenv('MESSAGE_TEMPLATE_CACHE_SIZE') or 1000)
+
+# после SUPPRESSION_BOUNCE_LIMIT постоянных отказов сервера (5xx) по адресу за SUPPRESSION_BOUNCE_WINDOW дней
+# адрес попадает в стоп-лист; счетчики отказов хранятся в базе и общие для всех процессов
+SUPPRESSION_BOUNCE_LIMIT = int(os.getenv('SUPPRESSION_BOUNCE_LIMIT') or 3)
+SUPPRESSION_BOUNCE_WINDOW = int(os.getenv('SUPPRESSION_BOUNCE_WINDOW') or 30)
+# доля ложных срабатываний фильтра Блума стоп-листа, срабатывания проверяются запросом к базе
+SUPPRESSION_BLOOM_ERROR_RATE = float(os.getenv('SUPPRESSION_BLOOM_ERROR_RATE') or 0.01)
+
+LOG_BUFFER_SIZE = int(os.getenv('LOG_BUFFER_SIZE') or 1000)
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL') or 5)
 
 CACHE_ENABLED = os.getenv('CACHE_ENABLED', False) == 'True'
 if CACHE_ENABLED:
@@ -158,3 +228,11 @@ if CACHE_ENABLED:
             'LOCATION': os.getenv('LOCATION')
         }
     }
+
+# писем в секунду на SMTP-сервер и на владельца рассылки, 0 - без ограничения
+RATE_LIMIT_RELAY = float(os.getenv('RATE_LIMIT_RELAY') or 0)
+RATE_LIMIT_OWNER = float(os.getenv('RATE_LIMIT_OWNER') or 0)
+# запас токенов в секундах работы на полной скорости
+RATE_LIMIT_BURST = float(os.getenv('RATE_LIMIT_BURST') or 1)
+# общий для всех процессов лимит через Redis, требует включенного кеширования
+RATE_LIMIT_SHARED = CACHE_ENABLED and os.getenv('RATE_LIMIT_SHARED', False) == 'True'
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from main.models import Client, Message, Mailing, Log
+from main.models import Client, Message, Mailing, Log, Delivery, Suppression, Bounce
 
 
 @admin.register(Client)
@@ -27,3 +27,22 @@ class MailingAdmin(admin.ModelAdmin):
 class LogAdmin(admin.ModelAdmin):
     list_display = ('last_attempt_time', 'attempt_status', 'server_response', 'mailing',)
     search_fields = ('last_attempt_time', 'attempt_status', 'server_response', 'mailing',)
+
+
+@admin.register(Delivery)
+class DeliveryAdmin(admin.ModelAdmin):
+    list_display = ('mailing', 'client', 'run_time', 'state', 'attempts', 'next_attempt_time',)
+    list_filter = ('state',)
+
+
+@admin.register(Suppression)
+class SuppressionAdmin(admin.ModelAdmin):
+    list_display = ('email', 'reason', 'created_at',)
+    list_filter = ('reason',)
+    search_fields = ('email', 'server_response',)
+
+
+@admin.register(Bounce)
+class BounceAdmin(admin.ModelAdmin):
+    list_display = ('email', 'count', 'window_start',)
+    search_fields = ('email', 'server_response',)
@@ -0,0 +1,283 @@
+import asyncio
+from collections import deque
+
+import aiosmtplib
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import connections
+
+from main.breaker import CircuitOpenError, get_breaker, is_transport_error
+from main.coalescing import coalescer
+from main.executor import chunked, plan_batches
+from main.log_sink import log_sink
+from main.payload import get_envelope_size, get_message_template
+from main.ratelimit import rate_limiter
+from main.relays import get_relay_pool
+from main.suppression import is_hard_bounce, suppression_list
+
+
+class AsyncSMTPSession:
+    """Асинхронное SMTP-соединение со счетчиком отправленных писем"""
+
+    def __init__(self, **smtp_kwargs):
+        self.smtp_kwargs = smtp_kwargs
+        self.client = None
+        self.sent = 0
+
+    async def connect(self):
+        self.client = aiosmtplib.SMTP(**self.smtp_kwargs)
+        await self.client.connect()
+        self.sent = 0
+
+    async def close(self):
+        if self.client is not None and self.client.is_connected:
+            try:
+                await self.client.quit()
+            except aiosmtplib.SMTPException:
+                self.client.close()
+        self.client = None
+
+    async def reconnect(self):
+        await self.close()
+        await self.connect()
+
+    async def deliver(self, message):
+        """Отправляет письмо, возвращает количество получателей, которым оно принято сервером"""
+        if isinstance(message, EmailMessage):
+            await self.client.send_message(message.message(), sender=message.from_email,
+                                           recipients=message.recipients())
+            return 1
+        # письмо из шаблона рассылки уже сериализовано, отказы по отдельным получателям остаются в message.refused
+        recipients = message.recipients()
+        refused, _ = await self.client.sendmail(message.from_email, recipients, message.data)
+        # отказы в том же виде, что у smtplib: {адрес: (код, ответ)}
+        message.refused = {address: (response.code, response.message) for address, response in refused.items()}
+        return len(recipients) - len(message.refused)
+
+
+class AsyncSMTPPool:
+    """Пул асинхронных SMTP-соединений.
+
+    Количество соединений равно количеству писем, одновременно находящихся в отправке.
+    Соединение пересоздается после max_messages писем и при обрыве.
+    Письма отправляются через предохранитель SMTP-сервера.
+    """
+
+    def __init__(self, size=None, max_messages=None, host=None, port=None, username=None, password=None,
+                 use_tls=None, use_ssl=None, timeout=None, name=None):
+        self.size = size or settings.DISPATCH_ASYNC_IN_FLIGHT
+        self.max_messages = max_messages or settings.EMAIL_CONNECTION_MAX_MESSAGES
+        username = settings.EMAIL_HOST_USER if username is None else username
+        password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.smtp_kwargs = {
+            'hostname': host or settings.EMAIL_HOST,
+            'port': int(port or settings.EMAIL_PORT),
+            'start_tls': settings.EMAIL_USE_TLS if use_tls is None else use_tls,
+            'use_tls': settings.EMAIL_USE_SSL if use_ssl is None else use_ssl,
+            'timeout': timeout or 60,
+        }
+        # как и EmailBackend, авторизуемся только при заданных логине и пароле
+        if username and password:
+            self.smtp_kwargs.update(username=username, password=password)
+        self.breaker = get_breaker(name or self.smtp_kwargs['hostname'])
+        self._idle = asyncio.Queue()
+        self._sessions = []
+
+    async def acquire(self):
+        """Возвращает свободное соединение, при необходимости открывает новое"""
+        if self._idle.empty() and len(self._sessions) < self.size:
+            session = AsyncSMTPSession(**self.smtp_kwargs)
+            self._sessions.append(session)
+            try:
+                await session.connect()
+            except BaseException:
+                self._sessions.remove(session)
+                raise
+            return session
+        return await self._idle.get()
+
+    def release(self, session):
+        self._idle.put_nowait(session)
+
+    async def send(self, message):
+        """Отправляет письмо через свободное соединение пула"""
+        with self.breaker.guard(wait=False):
+            session = await self.acquire()
+            try:
+                if session.client is None or session.sent >= self.max_messages:
+                    await session.reconnect()
+                try:
+                    sent = await session.deliver(message)
+                except aiosmtplib.SMTPServerDisconnected:
+                    await session.reconnect()
+                    sent = await session.deliver(message)
+                session.sent += 1
+                return sent
+            finally:
+                self.release(session)
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        for session in self._sessions:
+            await session.close()
+        self._sessions = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class AsyncRelayPool:
+    """Пулы асинхронных соединений со всеми SMTP-серверами из EMAIL_RELAYS.
+
+    Сервер для каждого письма выбирается пулом серверов (main.relays),
+    если сервер недоступен, письмо отправляется через следующий.
+    """
+
+    def __init__(self, relays=None, size=None):
+        self.relays = relays or get_relay_pool()
+        self.size = size or settings.DISPATCH_ASYNC_IN_FLIGHT
+        self.pools = {
+            relay: AsyncSMTPPool(size=relay.concurrency or self.size, host=relay.host, port=relay.port,
+                                 username=relay.username, password=relay.password, use_tls=relay.use_tls,
+                                 use_ssl=relay.use_ssl, name=relay.name)
+            for relay in self.relays.relays
+        }
+
+    async def send(self, message):
+        """Отправляет письмо через выбранный сервер, при его недоступности - через следующий"""
+        tried, error = [], None
+        while True:
+            relay = self.relays.acquire(exclude=tried, limited=False)
+            if relay is None:
+                raise error or self.relays.get_open_error()
+            try:
+                await rate_limiter.aacquire(relay=relay.name, tokens=len(message.recipients()))
+                sent = await self.pools[relay].send(message)
+            except CircuitOpenError:
+                pass
+            except Exception as exc:
+                self.relays.count(relay, 'failed')
+                if not is_transport_error(exc):
+                    raise
+                error = exc
+            else:
+                self.relays.count(relay, 'sent')
+                return sent
+            finally:
+                self.relays.release(relay)
+            self.relays.count(relay, 'failovers')
+            tried.append(relay)
+
+    async def close(self):
+        for pool in self.pools.values():
+            await pool.close()
+        self.relays.publish()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+async def send_to_clients(pool, mailing, clients):
+    """Отправка письма рассылки клиентам одной SMTP-транзакцией с записью попытки каждого клиента в лог,
+    возвращает количество клиентов, которым письмо принято сервером"""
+    message = get_message_template(mailing).render_envelope(clients)
+    try:
+        await rate_limiter.aacquire(owner_id=mailing.owner_id, tokens=len(clients))
+        await pool.send(message)
+        refused = message.refused
+    except aiosmtplib.SMTPRecipientsRefused as error:
+        refused = {refusal.recipient: (refusal.code, refusal.message) for refusal in error.recipients}
+    except (aiosmtplib.SMTPException, OSError) as error:
+        refused = dict.fromkeys(message.recipients(), error)
+    sent, bounces = 0, []
+    for client, address in zip(clients, message.recipients()):
+        if address in refused:
+            log_sink.append(mailing, 'Безуспешно', refused[address])
+            coalescer.record(mailing, client, 'Безуспешно', refused[address])
+            print('Ошибка')
+            if is_hard_bounce(refused[address]):
+                bounces.append((client['email'], refused[address]))
+        else:
+            log_sink.append(mailing, 'Успешно', 1)
+            coalescer.record(mailing, client, 'Успешно', 1)
+            sent += 1
+    if bounces:
+        await sync_to_async(suppression_list.record_bounces)(bounces)
+    if log_sink.is_due():
+        await sync_to_async(log_sink.flush)()
+    return sent
+
+
+async def dispatch_mailings(mailings):
+    """Асинхронная отправка рассылок, возвращает словарь {рассылка: количество отправленных писем}.
+
+    Клиенты берутся из пачек в порядке взвешенного обхода владельцев, одновременно
+    отправляется не больше DISPATCH_ASYNC_IN_FLIGHT писем. Контрольная точка сохраняется,
+    когда обработан последний клиент пачки. Письмо без подстановок отправляется сразу
+    EMAIL_ENVELOPE_SIZE клиентам пачки. Если срабатывают предохранители всех SMTP-серверов,
+    отправка останавливается, а недообработанные пачки повторяются со следующего запуска:
+    все рассылки запуска считаются незавершенными, так как часть их пачек еще не выбрана из базы.
+    Клиенты следующей пачки выбираются из базы, когда разобраны письма предыдущей.
+    """
+    batches, results = await sync_to_async(plan_batches)(mailings)
+    envelopes, remaining = deque(), {}
+    lock = asyncio.Lock()
+    stopped = asyncio.Event()
+
+    def take_batch():
+        for batch in batches:
+            if not batch.clients:
+                # все клиенты пачки в стоп-листе
+                batch.done()
+                continue
+            remaining[batch] = len(batch.clients)
+            envelopes.extend((batch, clients) for clients in chunked(batch.clients, get_envelope_size(batch.mailing)))
+            return batch
+        return None
+
+    async def next_envelope():
+        # пачки общие для всех обработчиков, под блокировкой клиенты не дублируются
+        async with lock:
+            if not envelopes and await sync_to_async(take_batch)() is None:
+                return None
+            return envelopes.popleft()
+
+    async def worker(pool):
+        while not stopped.is_set() and (envelope := await next_envelope()) is not None:
+            batch, clients = envelope
+            while True:
+                try:
+                    batch.sent += await send_to_clients(pool, batch.mailing, clients)
+                    break
+                except CircuitOpenError:
+                    if not pool.relays.is_available():
+                        stopped.set()
+                        return
+                    # идет пробное письмо после паузы, ждем его результата
+                    await asyncio.sleep(0.1)
+            remaining[batch] -= len(clients)
+            if not remaining[batch]:
+                await sync_to_async(batch.done)()
+                results[batch.mailing] += batch.sent
+
+    async with AsyncRelayPool() as pool:
+        await asyncio.gather(*(worker(pool) for _ in range(pool.size)))
+    await sync_to_async(coalescer.finish)()
+    if stopped.is_set():
+        # контрольные точки сохраняются, следующий запуск продолжит рассылки с них
+        for mailing in mailings:
+            mailing.run_finished = False
+    await sync_to_async(connections.close_all)()
+    return results
+
+
+def dispatch_async(mailings):
+    """Запуск асинхронной отправки рассылок из синхронного кода планировщика"""
+    return asyncio.run(dispatch_mailings(mailings))
@@ -0,0 +1,541 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.mail import EmailMessage, get_connection, send_mail
+from django.db import connection, transaction
+from django.utils import timezone
+
+from main.models import Mailing
+from main.smtp_stub import StubSMTPServer
+from main.transport import SMTPSession
+
+SCENARIOS = {}
+
+SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+
+
+def scenario(name):
+    """Декоратор для регистрации сценария замера"""
+    def decorator(func):
+        SCENARIOS[name] = func
+        return func
+    return decorator
+
+
+def stub_backend_kwargs(server):
+    """Параметры SMTP-бэкенда для подключения к локальному серверу-заглушке"""
+    return {
+        'backend': SMTP_BACKEND,
+        'host': server.host,
+        'port': server.port,
+        'username': '',
+        'password': '',
+        'use_tls': False,
+        'use_ssl': False,
+    }
+
+
+@scenario('smtp_pool')
+def bench_smtp_pool(count=1000, connect_delay=0.005):
+    """Сравнение отправки send_mail с новым соединением на каждое письмо и через SMTPSession"""
+    recipients = [f'client{i}@example.com' for i in range(count)]
+    with StubSMTPServer(connect_delay=connect_delay) as server:
+        backend_kwargs = stub_backend_kwargs(server)
+
+        started = time.perf_counter()
+        for email in recipients:
+            send_mail('Тема', 'Текст', 'from@example.com', [email],
+                      connection=get_connection(fail_silently=False, **backend_kwargs))
+        per_message = time.perf_counter() - started
+        per_message_connections = server.connections
+
+        started = time.perf_counter()
+        with SMTPSession(**backend_kwargs) as session:
+            for email in recipients:
+                session.send(EmailMessage('Тема', 'Текст', 'from@example.com', [email]))
+        pooled = time.perf_counter() - started
+        pooled_connections = server.connections - per_message_connections
+
+    return {
+        'messages': count,
+        'send_mail, msg/s': round(count / per_message, 1),
+        'send_mail, connections': per_message_connections,
+        'SMTPSession, msg/s': round(count / pooled, 1),
+        'SMTPSession, connections': pooled_connections,
+        'speedup': round(per_message / pooled, 2),
+    }
+
+
+@scenario('async_pool')
+def bench_async_pool(count=1000, message_delay=0.005, in_flight=100):
+    """Сравнение последовательной отправки через SMTPSession и асинхронной через AsyncSMTPPool"""
+    import asyncio
+
+    from main.async_dispatch import AsyncSMTPPool
+
+    messages = [EmailMessage('Тема', 'Текст', 'from@example.com', [f'client{i}@example.com'])
+                for i in range(count)]
+    with StubSMTPServer(message_delay=message_delay) as server:
+        started = time.perf_counter()
+        with SMTPSession(**stub_backend_kwargs(server)) as session:
+            for message in messages:
+                session.send(message)
+        sequential = time.perf_counter() - started
+
+        async def send_all():
+            async with AsyncSMTPPool(size=in_flight, host=server.host, port=server.port, username='',
+                                     password='', use_tls=False, use_ssl=False) as pool:
+                await asyncio.gather(*(pool.send(message) for message in messages))
+
+        started = time.perf_counter()
+        asyncio.run(send_all())
+        concurrent = time.perf_counter() - started
+
+    return {
+        'messages': count,
+        'in flight': in_flight,
+        'SMTPSession, msg/s': round(count / sequential, 1),
+        'AsyncSMTPPool, msg/s': round(count / concurrent, 1),
+        'speedup': round(sequential / concurrent, 2),
+    }
+
+
+@scenario('due_mailings')
+def bench_due_mailings(count=100_000, due_share=0.01):
+    """Сравнение выборки рассылок к отправке: перебор активных в Python и запрос по индексу mailing_due_idx.
+
+    Рассылки создаются внутри транзакции, которая откатывается после замера.
+    """
+    from main.models import Message
+    from main.services import get_due_mailings
+
+    now = timezone.now()
+    report = {'mailings': count}
+    with transaction.atomic():
+        letter = Message.objects.create(title='Тема', text='Текст')
+        Mailing.objects.bulk_create(
+            Mailing(
+                letter=letter,
+                start_time=now - timedelta(days=30),
+                next_time=(now - timedelta(minutes=1) if random.random() < due_share
+                           else now + timedelta(hours=random.randint(1, 720))),
+                end_time=now + timedelta(days=365),
+                status=Mailing.STARTED,
+            )
+            for _ in range(count)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Mailing._meta.db_table}')
+
+        started = time.perf_counter()
+        scanned = [mailing for mailing in Mailing.objects.filter(is_active=True)
+                   if mailing.next_time <= now <= mailing.end_time]
+        report['python scan, ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+        started = time.perf_counter()
+        due = list(get_due_mailings(now))
+        report['indexed query, ms'] = round((time.perf_counter() - started) * 1000, 1)
+        report['due mailings'] = f'{len(due)} (python scan: {len(scanned)})'
+        report['query plan'] = get_due_mailings(now).explain()
+
+        transaction.set_rollback(True)
+    return report
+
+
+@scenario('spreading')
+def bench_spreading(count=1000, window=60, audience=(50, 500)):
+    """Модель нагрузки: count рассылок стартуют в одну минуту, сравнивается отношение пиковой
+    поминутной нагрузки к средней без окна распределения и с окном в window минут"""
+    from main.spreading import EVEN, HASH, get_offset
+
+    audiences = [random.randint(*audience) for _ in range(count)]
+    messages = sum(audiences)
+
+    def peak_to_average(mode):
+        per_minute = [0] * window
+        client_id = 0
+        for total in audiences:
+            for index in range(total):
+                client_id += 1
+                offset = get_offset(index, total, client_id, window * 60, mode) if mode else 0
+                per_minute[int(offset // 60)] += 1
+        return round(max(per_minute) / (messages / window), 2), max(per_minute)
+
+    report = {'mailings': count, 'messages': messages, 'window, min': window}
+    for name, mode in (('no window', None), ('even', EVEN), ('hash', HASH)):
+        ratio, peak = peak_to_average(mode)
+        report[f'{name}: peak/avg'] = ratio
+        report[f'{name}: peak msg/min'] = peak
+    return report
+
+
+@scenario('mime_payload')
+def bench_mime_payload(count=10000):
+    """Сравнение сборки письма для каждого получателя через EmailMessage и из шаблона рассылки"""
+    from main.payload import MessageTemplate
+
+    subject = 'Новости компании за неделю'
+    body = 'Здравствуйте!\n\n' + 'Текст рассылки с кириллицей и длинными строками. ' * 40
+    recipients = [{'pk': i, 'email': f'client{i}@example.com'} for i in range(count)]
+
+    started = time.perf_counter()
+    for row in recipients:
+        EmailMessage(subject, body, 'from@example.com', [row['email']]).message().as_bytes(linesep='\r\n')
+    per_message = time.perf_counter() - started
+
+    started = time.perf_counter()
+    template = MessageTemplate(subject, body, 'from@example.com')
+    for row in recipients:
+        template.render(row)
+    prepared = time.perf_counter() - started
+
+    return {
+        'messages': count,
+        'EmailMessage, us/msg': round(per_message / count * 1e6, 1),
+        'MessageTemplate, us/msg': round(prepared / count * 1e6, 1),
+        'speedup': round(per_message / prepared, 2),
+    }
+
+
+@scenario('personalization')
+def bench_personalization(count=100000, sample=2000):
+    """Стоимость подстановки данных клиента в письмо: разобранный шаблон против шаблонов Django
+    и сборки EmailMessage для каждого получателя; время пересчитывается на 100 тысяч получателей"""
+    from django.template import Context, Engine
+
+    from main.payload import MessageTemplate
+    from main.personalization import compile_template
+
+    subject = 'Новости для {{ first_name }}'
+    body = ('Здравствуйте, {{ first_name }} {{ patronymic }}!\n\n'
+            + 'Текст рассылки с кириллицей и длинными строками. ' * 40
+            + '\n\nПисьмо отправлено на {{ email }}')
+    rows = [{'pk': i, 'first_name': f'Имя{i}', 'last_name': f'Фамилия{i}', 'patronymic': 'Отчество',
+             'email': f'client{i}@example.com'} for i in range(count)]
+    per_100k = 100000
+
+    started = time.perf_counter()
+    compiled = compile_template(body)
+    compile_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for row in rows:
+        compiled.render(row)
+    text_render = (time.perf_counter() - started) / count * per_100k
+
+    started = time.perf_counter()
+    template = MessageTemplate(subject, body, 'from@example.com')
+    for row in rows:
+        template.render(row)
+    message_render = (time.perf_counter() - started) / count * per_100k
+
+    # шаблоны Django и сборка EmailMessage медленные, замеряются на выборке
+    django_template = Engine().from_string(body)
+    started = time.perf_counter()
+    for row in rows[:sample]:
+        django_template.render(Context(row))
+    django_render = (time.perf_counter() - started) / min(count, sample) * per_100k
+
+    started = time.perf_counter()
+    for row in rows[:sample]:
+        EmailMessage(compile_template(subject).render(row), compiled.render(row), 'from@example.com',
+                     [row['email']]).message().as_bytes(linesep='\r\n')
+    email_message = (time.perf_counter() - started) / min(count, sample) * per_100k
+
+    return {
+        'recipients': count,
+        'compile, us': round(compile_time * 1e6, 1),
+        'text render per 100k, s': round(text_render, 3),
+        'Django template per 100k, s': round(django_render, 3),
+        'MessageTemplate per 100k, s': round(message_render, 3),
+        'EmailMessage per 100k, s': round(email_message, 3),
+    }
+
+
+@scenario('envelope')
+def bench_envelope(count=1000, size=50, message_delay=0.002, refused_share=0.05):
+    """Сравнение отправки письма без подстановок каждому получателю отдельно и одной SMTP-транзакцией
+    сразу size получателям; часть адресов сервер отклоняет, отказы сопоставляются с получателями"""
+    from smtplib import SMTPRecipientsRefused
+
+    from main.executor import chunked
+    from main.payload import MessageTemplate
+
+    rows = [{'pk': i, 'email': f'client{i}@example.com'} for i in range(count)]
+    refused = {row['email'] for row in random.sample(rows, int(count * refused_share))}
+    template = MessageTemplate('Новости компании', 'Текст рассылки для всех клиентов', 'from@example.com')
+
+    def send(session, envelope):
+        message = template.render_envelope(envelope)
+        try:
+            session.send(message)
+        except SMTPRecipientsRefused as error:
+            return set(error.recipients)
+        return set(message.refused)
+
+    report = {'recipients': count, 'envelope size': size, 'refused by server': len(refused)}
+    with StubSMTPServer(message_delay=message_delay, refuse=refused) as server:
+        for name, envelope_size in (('per recipient', 1), ('envelope', size)):
+            messages = server.messages
+            started = time.perf_counter()
+            with SMTPSession(**stub_backend_kwargs(server)) as session:
+                mapped = set().union(*(send(session, envelope) for envelope in chunked(rows, envelope_size)))
+            elapsed = time.perf_counter() - started
+            report[f'{name}: DATA transactions'] = server.messages - messages
+            report[f'{name}: recipients/s'] = round(count / elapsed, 1)
+            report[f'{name}: refusals mapped'] = 'ok' if mapped == refused else f'{len(mapped)} != {len(refused)}'
+    report['speedup'] = round(report['envelope: recipients/s'] / report['per recipient: recipients/s'], 2)
+    return report
+
+
+@scenario('dkim')
+def bench_dkim(count=1000, key_size=2048):
+    """Сравнение подписи DKIM каждого письма с разбором ключа и хешированием тела заново
+    и подписи из шаблона рассылки с заранее загруженным ключом и хешем тела"""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    from main.dkim import DKIMSigner, split_message
+    from main.payload import MessageTemplate
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    rows = [{'pk': i, 'email': f'client{i}@example.com'} for i in range(count)]
+    template = MessageTemplate('Новости компании', 'Текст рассылки с кириллицей и длинными строками. ' * 100,
+                               'from@example.com')
+    messages = [template.render(row).data for row in rows]
+
+    started = time.perf_counter()
+    for data in messages:
+        DKIMSigner('example.com', 'default', private_key).sign(data)
+    naive = time.perf_counter() - started
+
+    started = time.perf_counter()
+    signer = DKIMSigner('example.com', 'default', private_key)
+    body_hash = signer.hash_body(split_message(template.data)[1])
+    for data in messages:
+        signer.sign(data, body_hash)
+    cached = time.perf_counter() - started
+
+    return {
+        'messages': count,
+        'body, KB': len(template.data) // 1024,
+        'naive, ms/msg': round(naive / count * 1000, 3),
+        'preloaded key and body hash, ms/msg': round(cached / count * 1000, 3),
+        'speedup': round(naive / cached, 2),
+    }
+
+
+@scenario('recipients')
+def bench_recipients(count=100_000, page_size=500):
+    """Пиковая память и время обхода клиентов рассылки: объекты модели через mailing.clients.all()
+    и страницы keyset по таблице связи (get_recipient_pages). Данные создаются в транзакции, которая откатывается"""
+    import tracemalloc
+
+    from main.models import Client
+    from main.personalization import get_recipient_pages
+    from users.models import User
+
+    def measure(func):
+        tracemalloc.start()
+        started = time.perf_counter()
+        seen = func()
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return seen, round(elapsed, 2), round(peak / 2 ** 20, 1)
+
+    report = {'recipients': count, 'page size': page_size}
+    with transaction.atomic():
+        owner = User.objects.create(email=f'benchmark-{time.time_ns()}@example.com')
+        now = timezone.now()
+        mailing = Mailing.objects.create(start_time=now, end_time=now + timedelta(days=1), owner=owner)
+        comment = 'Комментарий к клиенту. ' * 20
+        clients = Client.objects.bulk_create(
+            (Client(first_name=f'Имя{i}', last_name=f'Фамилия{i}', email=f'benchmark{i}@example.com',
+                    comment=comment, owner=owner) for i in range(count)),
+            batch_size=5000,
+        )
+        Mailing.clients.through.objects.bulk_create(
+            (Mailing.clients.through(mailing_id=mailing.pk, client_id=client.pk) for client in clients),
+            batch_size=5000,
+        )
+        del clients
+
+        seen, elapsed, peak = measure(lambda: len([client.email for client in mailing.clients.all()]))
+        report['clients.all(): clients'] = seen
+        report['clients.all(): s'] = elapsed
+        report['clients.all(): peak MB'] = peak
+
+        seen, elapsed, peak = measure(
+            lambda: sum(len(page) for page in get_recipient_pages(mailing, page_size=page_size))
+        )
+        report['keyset pages: clients'] = seen
+        report['keyset pages: s'] = elapsed
+        report['keyset pages: peak MB'] = peak
+
+        transaction.set_rollback(True)
+    return report
+
+
+@scenario('dispatch_plan')
+def bench_dispatch_plan(count=1000, scales=((10, 0.1), (10, 1), (50, 0.1), (50, 1))):
+    """Количество запросов на захват рассылок и построение плана отправки (plan_batches) при разном
+    числе рассылок и клиентов: count клиентов умножается на долю из scales. Выборка клиентов пачками
+    считается отдельно, это один запрос на пачку. Данные создаются в транзакции, которая откатывается"""
+    from django.test.utils import CaptureQueriesContext
+
+    from main.executor import plan_batches
+    from main.leases import claim_mailings, get_worker_id
+    from main.models import Client, Message
+    from main.services import get_due_mailings
+    from users.models import User
+
+    report = {}
+    for mailings_count, share in scales:
+        recipients = max(int(count * share), 1)
+        with transaction.atomic():
+            owner = User.objects.create(email=f'benchmark-{time.time_ns()}@example.com')
+            letter = Message.objects.create(title='Тема {{ first_name }}', text='Текст', owner=owner)
+            clients = Client.objects.bulk_create(
+                Client(first_name=f'Имя{i}', last_name=f'Фамилия{i}', email=f'benchmark{i}@example.com', owner=owner)
+                for i in range(recipients)
+            )
+            now = timezone.now()
+            mailings = Mailing.objects.bulk_create(
+                Mailing(start_time=now - timedelta(minutes=1), next_time=now - timedelta(minutes=1),
+                        end_time=now + timedelta(days=1), status=Mailing.STARTED, letter=letter, owner=owner)
+                for _ in range(mailings_count)
+            )
+            Mailing.clients.through.objects.bulk_create(
+                Mailing.clients.through(mailing_id=mailing.pk, client_id=client.pk)
+                for mailing in mailings for client in clients
+            )
+
+            with CaptureQueriesContext(connection) as plan_queries:
+                claimed = claim_mailings(get_due_mailings(now).filter(owner=owner), get_worker_id(),
+                                         limit=mailings_count)
+                batches, _ = plan_batches(claimed, batch_size=recipients, now=now)
+            with CaptureQueriesContext(connection) as page_queries:
+                planned = sum(len(batch.clients) for batch in batches)
+
+            report[f'{mailings_count} mailings x {recipients} clients'] = (
+                f'plan queries: {len(plan_queries)}, batch queries: {len(page_queries)}, clients: {planned}'
+            )
+            transaction.set_rollback(True)
+    return report
+
+
+@scenario('suppression')
+def bench_suppression(count=1000, suppressed=100_000, suppressed_share=0.02, page_size=500):
+    """Проверка count клиентов по стоп-листу из suppressed адресов: запрос к базе на каждого клиента
+    и фильтр Блума с подтверждением попаданий одним запросом на пачку; доля suppressed_share клиентов
+    в стоп-листе. Данные создаются в транзакции, которая откатывается"""
+    from django.test.utils import CaptureQueriesContext
+
+    from main.models import Suppression
+    from main.suppression import SuppressionList
+
+    emails = [f'client{i}@example.com' for i in range(count)]
+    listed = set(random.sample(emails, int(count * suppressed_share)))
+    rows = [{'pk': i, 'email': email} for i, email in enumerate(emails)]
+    report = {'clients': count, 'suppressed addresses': suppressed}
+    with transaction.atomic():
+        Suppression.objects.bulk_create(
+            [Suppression(email=f'bounced{i}@example.com') for i in range(suppressed - len(listed))]
+            + [Suppression(email=email) for email in listed],
+            batch_size=5000,
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            kept = [row for row in rows if not Suppression.objects.filter(email=row['email']).exists()]
+            elapsed = time.perf_counter() - started
+        report['query per client: kept'] = len(kept)
+        report['query per client: queries'] = len(queries)
+        report['query per client: ms'] = round(elapsed * 1000, 1)
+
+        suppression_list = SuppressionList()
+        started = time.perf_counter()
+        suppression_list.load()
+        report['bloom filter: load ms'] = round((time.perf_counter() - started) * 1000, 1)
+        Suppression.objects.create(email='new@example.com')
+        started = time.perf_counter()
+        suppression_list.load()
+        report['bloom filter: next tick load ms'] = round((time.perf_counter() - started) * 1000, 1)
+        report['bloom filter: KB'] = round(len(suppression_list.filter.bits) / 1024, 1)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            kept = [row for page in range(0, count, page_size)
+                    for row in suppression_list.exclude(rows[page:page + page_size])]
+            elapsed = time.perf_counter() - started
+        report['bloom filter: kept'] = len(kept)
+        report['bloom filter: queries'] = len(queries)
+        report['bloom filter: ms'] = round(elapsed * 1000, 1)
+
+        unknown = [f'unknown{i}@example.com' for i in range(10_000)]
+        false_positives = sum(email in suppression_list.filter for email in unknown)
+        report['bloom filter: false positive %'] = round(false_positives / len(unknown) * 100, 2)
+        transaction.set_rollback(True)
+    return report
+
+
+@scenario('coalescing')
+def bench_coalescing(count=1000, mailings_count=5, audience_share=0.6):
+    """Сколько писем уходит клиентам mailings_count рассылок с одним письмом, аудитории которых (доля
+    audience_share из count клиентов) пересекаются: без объединения и с объединением одинаковых писем.
+    Отправка имитируется, каждый клиент пачки считается получившим письмо. Данные создаются
+    в транзакции, которая откатывается"""
+    from django.test.utils import CaptureQueriesContext
+
+    from main.coalescing import coalescer
+    from main.executor import plan_batches
+    from main.leases import claim_mailings, get_worker_id
+    from main.log_sink import log_sink
+    from main.models import Client, Log, Message
+    from main.services import get_due_mailings
+    from users.models import User
+
+    report = {'clients': count, 'mailings': mailings_count}
+    with transaction.atomic():
+        owner = User.objects.create(email=f'benchmark-{time.time_ns()}@example.com')
+        letter = Message.objects.create(title='Новости компании', text='Текст рассылки для всех клиентов', owner=owner)
+        clients = Client.objects.bulk_create(
+            Client(first_name=f'Имя{i}', last_name=f'Фамилия{i}', email=f'benchmark{i}@example.com', owner=owner)
+            for i in range(count)
+        )
+        now = timezone.now()
+        mailings = Mailing.objects.bulk_create(
+            Mailing(start_time=now - timedelta(minutes=1), next_time=now - timedelta(minutes=1),
+                    end_time=now + timedelta(days=1), status=Mailing.STARTED, letter=letter, owner=owner)
+            for _ in range(mailings_count)
+        )
+        Mailing.clients.through.objects.bulk_create(
+            Mailing.clients.through(mailing_id=mailing.pk, client_id=client.pk)
+            for mailing in mailings for client in random.sample(clients, int(count * audience_share))
+        )
+        report['mailing-client pairs'] = pairs = Mailing.clients.through.objects.filter(mailing__in=mailings).count()
+
+        with CaptureQueriesContext(connection) as plan_queries:
+            claimed = claim_mailings(get_due_mailings(now).filter(owner=owner), get_worker_id(), limit=mailings_count)
+            batches, results = plan_batches(claimed, now=now)
+        sent = 0
+        for batch in batches:
+            for client in batch.clients:
+                log_sink.append(batch.mailing, 'Успешно', 1)
+                coalescer.record(batch.mailing, client, 'Успешно', 1)
+                batch.sent += 1
+            batch.done()
+            sent += batch.sent
+        coalescer.finish()
+        log_sink.flush()
+
+        report['plan queries'] = len(plan_queries)
+        report['emails without coalescing'] = pairs
+        report['emails with coalescing'] = sent
+        report['sends saved'] = coalescer.saved
+        report['log entries'] = Log.objects.filter(mailing__in=mailings).count()
+        report['counted as sent'] = sum(coalescer.add_results(results).values()) + sent
+        transaction.set_rollback(True)
+    return report
@@ -0,0 +1,161 @@
+import smtplib
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+
+import aiosmtplib
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# ошибки, означающие, что недоступен сам SMTP-сервер, а не отдельный получатель
+TRANSPORT_ERRORS = (
+    smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError,
+    aiosmtplib.SMTPConnectError, aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPTimeoutError,
+    aiosmtplib.SMTPHeloError, aiosmtplib.SMTPAuthenticationError,
+)
+
+
+def is_transport_error(error):
+    """Проверяет, что ошибка отправки говорит о недоступности SMTP-сервера"""
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    # 421 - сервер временно не обслуживает соединения
+    if getattr(error, 'smtp_code', None) == 421 or getattr(error, 'code', None) == 421:
+        return True
+    # сетевые ошибки сокета; отказы по отдельным письмам тоже OSError, но это SMTPException
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+class CircuitOpenError(Exception):
+    """Отправка на SMTP-сервер приостановлена предохранителем.
+
+    Функция отправки пачки записывает в processed и sent, сколько клиентов пачки
+    она успела обработать до срабатывания, чтобы контрольная точка не потеряла их.
+    """
+
+    def __init__(self, breaker):
+        super().__init__(f'SMTP-сервер {breaker.name} недоступен, отправка отложена до {breaker.retry_at}')
+        self.retry_at = breaker.retry_at
+        self.processed = 0
+        self.sent = 0
+
+
+class CircuitBreaker:
+    """Предохранитель для SMTP-сервера.
+
+    closed - письма отправляются, сбои подряд считаются; после threshold сбоев предохранитель
+    переходит в open, и отправка не выполняется до retry_at. Затем в состоянии half-open
+    отправляется одно пробное письмо: при успехе предохранитель закрывается, при сбое снова
+    открывается с удвоенной паузой, но не дольше max_timeout.
+    """
+
+    def __init__(self, name, threshold=None, timeout=None, max_timeout=None):
+        self.name = name
+        self.threshold = threshold or settings.SMTP_BREAKER_THRESHOLD
+        self.timeout = timeout or settings.SMTP_BREAKER_TIMEOUT
+        self.max_timeout = max_timeout or settings.SMTP_BREAKER_MAX_TIMEOUT
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.retry_at = None
+        self._probing = False
+        self._lock = threading.Condition()
+
+    def is_available(self):
+        """Можно ли сейчас отправлять письма (состояние предохранителя не меняется)"""
+        return self.state != OPEN or timezone.now() >= self.retry_at
+
+    def before_send(self, wait=True):
+        """Разрешает отправку или выбрасывает CircuitOpenError.
+
+        Пока идет пробное письмо, с wait=True поток дожидается его результата,
+        иначе сразу получает CircuitOpenError (для асинхронной отправки).
+        """
+        with self._lock:
+            if self.state == OPEN and timezone.now() >= self.retry_at:
+                self._set_state(HALF_OPEN)
+            while wait and self.state == HALF_OPEN and self._probing:
+                self._lock.wait()
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                raise CircuitOpenError(self)
+            if self.state == HALF_OPEN:
+                self._probing = True
+
+    def on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._lock.notify_all()
+            if self.state != CLOSED:
+                self.trips = 0
+                self.retry_at = None
+                self._set_state(CLOSED)
+
+    def on_failure(self, error):
+        """Учитывает ошибку отправки: отказ по отдельному письму значит, что сервер доступен"""
+        if not is_transport_error(error):
+            self.on_success()
+            return
+        with self._lock:
+            if self.state == OPEN:
+                # письмо ушло в отправку до срабатывания предохранителя
+                return
+            self.failures += 1
+            self._probing = False
+            self._lock.notify_all()
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.trips += 1
+                pause = min(self.timeout * 2 ** (self.trips - 1), self.max_timeout)
+                self.retry_at = timezone.now() + timedelta(seconds=pause)
+                self._set_state(OPEN)
+
+    @contextmanager
+    def guard(self, wait=True):
+        """Оборачивает отправку письма: проверяет предохранитель и учитывает результат"""
+        self.before_send(wait)
+        try:
+            yield
+        except Exception as error:
+            self.on_failure(error)
+            raise
+        self.on_success()
+
+    def get_state(self):
+        """Состояние предохранителя для мониторинга"""
+        return {
+            'host': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'retry_at': self.retry_at,
+            'changed_at': timezone.now(),
+        }
+
+    def _set_state(self, state):
+        self.state = state
+        print(f'предохранитель SMTP-сервера {self.name}: {state}'
+              + (f' до {self.retry_at}' if state == OPEN else ''))
+        # состояние публикуется в кеш, откуда его читает команда smtpstatus
+        cache.set(get_state_key(self.name), self.get_state(), None)
+
+
+def get_state_key(host):
+    return f'smtp_breaker:{host}'
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(host=None):
+    """Предохранитель SMTP-сервера host, один на процесс"""
+    host = host or settings.EMAIL_HOST
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
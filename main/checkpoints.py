@@ -0,0 +1,72 @@
+import threading
+
+from main.models import Checkpoint
+
+
+class RunProgress:
+    """Прогресс запуска рассылки с контрольной точкой в базе.
+
+    Клиенты обрабатываются пачками в порядке pk. Пачки могут завершаться в любом порядке,
+    но контрольная точка сдвигается только по непрерывному ряду завершенных пачек,
+    поэтому после падения планировщика отправка продолжается с первого необработанного клиента.
+    """
+
+    def __init__(self, mailing, checkpoint=None):
+        self.mailing = mailing
+        if checkpoint is None:
+            checkpoint, _ = Checkpoint.objects.get_or_create(mailing_id=mailing.pk, run_time=mailing.next_time)
+        self.checkpoint = checkpoint
+        # письма, отправленные до падения, учитываются в итогах запуска
+        self.sent = self.checkpoint.sent
+        if self.checkpoint.processed:
+            print(f'рассылка {mailing.pk} продолжена с клиента {self.checkpoint.last_client_id}, '
+                  f'повторно не обрабатывается клиентов: {self.checkpoint.processed}')
+        self._lock = threading.Lock()
+        self._batches = []
+        self._done = {}
+        self._next = 0
+        self._stopped = False
+
+    def add_batch(self, clients):
+        """Регистрирует пачку клиентов, возвращает ее номер"""
+        with self._lock:
+            self._batches.append(clients[-1]['pk'])
+            return len(self._batches) - 1
+
+    def done(self, index, processed, sent, last_client_id=None):
+        """Отмечает пачку обработанной и сохраняет контрольную точку, если она сдвинулась.
+
+        Для пачки, отправка которой прервалась на середине, передается last_client_id
+        последнего обработанного клиента: контрольная точка останавливается на нем,
+        и следующие пачки запуска ее уже не сдвигают.
+        """
+        with self._lock:
+            self._done[index] = (processed, sent, last_client_id)
+            if self._stopped or self._next not in self._done:
+                return
+            while not self._stopped and self._next in self._done:
+                processed, sent, last_client_id = self._done.pop(self._next)
+                if processed:
+                    self.checkpoint.last_client_id = last_client_id or self._batches[self._next]
+                    self.checkpoint.processed += processed
+                    self.checkpoint.sent += sent
+                self._stopped = last_client_id is not None
+                self._next += 1
+            self.checkpoint.save(update_fields=['last_client_id', 'processed', 'sent'])
+
+
+def load_checkpoints(mailings):
+    """Контрольные точки текущих запусков рассылок {рассылка (pk): контрольная точка}.
+
+    Существующие читаются одним запросом, недостающие создаются одним bulk_create.
+    """
+    run_times = {mailing.pk: mailing.next_time for mailing in mailings}
+    checkpoints = {
+        checkpoint.mailing_id: checkpoint
+        for checkpoint in Checkpoint.objects.filter(mailing_id__in=run_times)
+        if checkpoint.run_time == run_times[checkpoint.mailing_id]
+    }
+    missing = [Checkpoint(mailing_id=mailing_id, run_time=run_time)
+               for mailing_id, run_time in run_times.items() if mailing_id not in checkpoints]
+    checkpoints.update((checkpoint.mailing_id, checkpoint) for checkpoint in Checkpoint.objects.bulk_create(missing))
+    return checkpoints
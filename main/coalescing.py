@@ -0,0 +1,124 @@
+import threading
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+
+from django.db.models import Count, Q
+
+from main.log_sink import log_sink
+from main.models import Mailing
+
+
+class Coalescer:
+    """Объединение одинаковых писем рассылок одного запуска.
+
+    Если клиент входит в несколько рассылок запуска с одинаковым письмом (тема и текст),
+    письмо отправляется ему один раз - рассылкой с меньшим pk (основной). Остальные рассылки
+    исключают клиента из своих пачек, а результат отправки основной рассылки записывается
+    в лог каждой из них и засчитывается им как отправка. Объединяются только рассылки,
+    все оставшиеся клиенты которых получают письмо в этом запуске (run_finished).
+    Клиент считается обработанным остальными рассылками, только когда основная рассылка
+    действительно попыталась отправить ему письмо: пачки с такими клиентами откладываются
+    до конца запуска (finish), и если основная рассылка до клиента не дошла (например, ее пачку
+    отложил предохранитель SMTP-сервера), контрольная точка остальных рассылок останавливается
+    перед ним, и следующий запуск отправит ему письмо.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # {(основная рассылка (pk), клиент (pk)): остальные рассылки с тем же письмом}
+        self.followers = {}
+        # пары (рассылка (pk), клиент (pk)), которым письмо отправит основная рассылка
+        self.skipped = set()
+        # пары из skipped, клиентам которых основная рассылка уже пыталась отправить письмо
+        self.covered = set()
+        # пачки, ожидающие попыток основных рассылок
+        self.postponed = []
+        self.sent = Counter()
+        self.saved = 0
+
+    def plan(self, mailings, after):
+        """Находит клиентов, которым в запуске уходит одно и то же письмо от нескольких рассылок.
+
+        after - {рассылка (pk): клиент, после которого клиенты рассылки еще не обработаны}.
+        Пары клиент-рассылка с клиентами, входящими больше чем в одну рассылку, читаются одним запросом.
+        """
+        self.reset()
+        letters = {}
+        for mailing in mailings:
+            if mailing.letter.title is not None and getattr(mailing, 'run_finished', True):
+                letters.setdefault(mailing.letter, []).append(mailing)
+        shared = {mailing.pk: mailing for group in letters.values() if len(group) > 1 for mailing in group}
+        if not shared:
+            return
+        condition = Q()
+        for mailing_id in shared:
+            condition |= Q(mailing_id=mailing_id, client_id__gt=after[mailing_id])
+        through = Mailing.clients.through.objects.filter(condition)
+        repeated = through.values('client_id').annotate(count=Count('mailing_id')).filter(count__gt=1)
+        pairs = (
+            through.filter(client_id__in=repeated.values('client_id'))
+            .order_by('client_id', 'mailing_id').values_list('client_id', 'mailing_id')
+        )
+        for client_id, group in groupby(pairs.iterator(), key=itemgetter(0)):
+            by_letter = {}
+            for _, mailing_id in group:
+                by_letter.setdefault(shared[mailing_id].letter, []).append(shared[mailing_id])
+            for primary, *followers in by_letter.values():
+                if followers:
+                    self.followers[(primary.pk, client_id)] = followers
+                    self.skipped.update((follower.pk, client_id) for follower in followers)
+
+    def exclude(self, mailing, clients):
+        """Клиенты пачки рассылки без тех, кому письмо отправит основная рассылка"""
+        if not self.skipped:
+            return clients
+        return [client for client in clients if (mailing.pk, client['pk']) not in self.skipped]
+
+    def record(self, mailing, client, attempt_status, server_response):
+        """Записывает результат отправки клиенту в лог остальных рассылок с тем же письмом"""
+        followers = self.followers.get((mailing.pk, client['pk']))
+        if not followers:
+            return
+        for follower in followers:
+            log_sink.append(follower, attempt_status, server_response)
+        with self._lock:
+            self.covered.update((follower.pk, client['pk']) for follower in followers)
+            self.saved += len(followers)
+            if attempt_status == 'Успешно':
+                self.sent.update(follower.pk for follower in followers)
+
+    def postpone(self, batch):
+        """Откладывает сохранение прогресса пачки с клиентами, которым письмо отправляет основная рассылка"""
+        with self._lock:
+            self.postponed.append(batch)
+
+    def get_uncovered(self, mailing, client_ids):
+        """Первый из клиентов (pk по возрастанию), которого рассылка пропустила, а основная рассылка
+        письмом так и не обработала, None - если таких нет"""
+        return next((client_id for client_id in client_ids
+                     if (mailing.pk, client_id) in self.skipped and (mailing.pk, client_id) not in self.covered), None)
+
+    def finish(self):
+        """Сохраняет прогресс отложенных пачек после того, как все пачки запуска отправлены"""
+        with self._lock:
+            postponed, self.postponed = self.postponed, []
+        stopped = 0
+        for batch in postponed:
+            uncovered = self.get_uncovered(batch.mailing, batch.client_ids)
+            batch.complete(uncovered)
+            stopped += uncovered is not None
+        if stopped:
+            print(f'пачек отложено до следующего запуска, основная рассылка не отправила письмо: {stopped}')
+
+    def add_results(self, results):
+        """Добавляет к результатам запуска {рассылка: отправлено писем} письма, отправленные основными рассылками"""
+        for mailing in results:
+            results[mailing] += self.sent[mailing.pk]
+        return results
+
+
+coalescer = Coalescer()
@@ -0,0 +1,103 @@
+import hashlib
+import re
+import threading
+from base64 import b64encode
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from django.conf import settings
+
+# заголовки, которые подписываются, если они есть в письме
+SIGNED_HEADERS = ('from', 'to', 'subject', 'date', 'message-id', 'mime-version', 'content-type',
+                  'content-transfer-encoding')
+
+# smtplib и aiosmtplib при отправке приводят все переводы строк к CRLF, подпись считается по тому же виду
+LINE_BREAK = re.compile(rb'\r\n|\n|\r')
+WHITESPACE = re.compile(rb'[ \t]+')
+# пустая строка после заголовков
+HEADERS_END = re.compile(rb'(\r\n|\n|\r)\1')
+
+
+def split_message(data):
+    """Заголовки и тело письма"""
+    match = HEADERS_END.search(data)
+    if match is None:
+        return data, b''
+    return data[:match.start()], data[match.end():]
+
+
+def canonicalize_body(body):
+    """Тело письма в каноническом виде relaxed (RFC 6376, 3.4.4)"""
+    lines = [WHITESPACE.sub(b' ', line).rstrip(b' ') for line in LINE_BREAK.split(body)]
+    while lines and not lines[-1]:
+        lines.pop()
+    return b'\r\n'.join(lines) + b'\r\n' if lines else b''
+
+
+def canonicalize_header(name, value):
+    """Заголовок в каноническом виде relaxed (RFC 6376, 3.4.2), без завершающего CRLF"""
+    value = WHITESPACE.sub(b' ', LINE_BREAK.sub(b'', value)).strip(b' ')
+    return name.strip().lower() + b':' + value
+
+
+def parse_headers(headers):
+    """Заголовки письма как {имя в нижнем регистре: значение}, при повторах - последний экземпляр"""
+    parsed = {}
+    name = None
+    for line in LINE_BREAK.split(headers):
+        if line[:1] in (b' ', b'\t') and name is not None:
+            parsed[name] = (parsed[name][0], parsed[name][1] + b'\r\n' + line)
+            continue
+        raw_name, _, value = line.partition(b':')
+        name = raw_name.strip().lower().decode('ascii', 'replace')
+        parsed[name] = (raw_name, value)
+    return parsed
+
+
+class DKIMSigner:
+    """Подпись писем DKIM (rsa-sha256, канонизация relaxed/relaxed).
+
+    Закрытый ключ разбирается один раз при создании подписчика. Хеш тела письма без подстановок
+    считается один раз на запуск рассылки (MessageTemplate), для каждого получателя подписываются
+    только заголовки.
+    """
+
+    def __init__(self, domain, selector, private_key):
+        self.domain = domain
+        self.selector = selector
+        self.private_key = serialization.load_pem_private_key(private_key, password=None)
+
+    @staticmethod
+    def hash_body(body):
+        """Хеш тела письма для тега bh"""
+        return b64encode(hashlib.sha256(canonicalize_body(body)).digest()).decode('ascii')
+
+    def sign(self, data, body_hash=None):
+        """Заголовок DKIM-Signature для письма data, body_hash - заранее посчитанный хеш тела"""
+        headers, body = split_message(data)
+        if body_hash is None:
+            body_hash = self.hash_body(body)
+        parsed = parse_headers(headers)
+        names = [name for name in SIGNED_HEADERS if name in parsed]
+        value = (f'v=1; a=rsa-sha256; c=relaxed/relaxed; d={self.domain}; s={self.selector}; '
+                 f'h={":".join(names)}; bh={body_hash}; b=')
+        signed = b''.join(canonicalize_header(*parsed[name]) + b'\r\n' for name in names)
+        signed += canonicalize_header(b'DKIM-Signature', value.encode('ascii'))
+        signature = self.private_key.sign(signed, padding.PKCS1v15(), hashes.SHA256())
+        return f'DKIM-Signature: {value}{b64encode(signature).decode("ascii")}\r\n'.encode('ascii')
+
+
+_signer = None
+_signer_lock = threading.Lock()
+
+
+def get_signer():
+    """Подписчик DKIM из настроек, один на процесс; None, если подпись не настроена"""
+    global _signer
+    if not (settings.DKIM_DOMAIN and settings.DKIM_PRIVATE_KEY):
+        return None
+    with _signer_lock:
+        if _signer is None:
+            with open(settings.DKIM_PRIVATE_KEY, 'rb') as file:
+                _signer = DKIMSigner(settings.DKIM_DOMAIN, settings.DKIM_SELECTOR, file.read())
+        return _signer
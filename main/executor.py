@@ -0,0 +1,149 @@
+from bisect import bisect_left
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from main.breaker import CircuitOpenError
+from main.checkpoints import RunProgress, load_checkpoints
+from main.coalescing import coalescer
+from main.fairness import get_owner_weights, weighted_round_robin
+from main.personalization import count_recipients_by_mailing, get_recipient_pages
+from main.spreading import get_allowed_count, get_spread_window
+from main.suppression import suppression_list
+
+
+def chunked(items, size):
+    """Разбивает список на части размером не больше size"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Batch:
+    """Пачка клиентов одной рассылки (строки values() с полями для подстановки).
+
+    Клиенты с адресами из стоп-листа и клиенты, которым то же письмо в этом запуске отправит
+    другая рассылка, исключаются из пачки до отправки, но считаются обработанными,
+    и контрольная точка сдвигается за них. Пачка может оказаться пустой.
+    Прогресс пачки, клиентам которой письмо отправляет другая рассылка, сохраняется в конце запуска
+    (Coalescer.finish), когда известно, до каких из них та рассылка дошла.
+    """
+
+    def __init__(self, mailing, progress, clients):
+        self.mailing = mailing
+        self.progress = progress
+        self.index = progress.add_batch(clients)
+        self.client_ids = [client['pk'] for client in clients]
+        kept = suppression_list.exclude(clients)
+        self.clients = coalescer.exclude(mailing, kept)
+        self.coalesced = len(self.clients) < len(kept)
+        self.skipped = len(clients) - len(self.clients)
+        self.sent = 0
+        # первый необработанный клиент (pk) пачки, отправка которой прервалась
+        self.stopped_at = None
+
+    def done(self):
+        if self.coalesced:
+            coalescer.postpone(self)
+        else:
+            self.complete()
+
+    def complete(self, uncovered=None):
+        """Сохраняет прогресс пачки: до первого необработанного клиента или клиента uncovered,
+        которому письмо не отправила основная рассылка, а если таких нет - всей пачки"""
+        stops = [client_id for client_id in (self.stopped_at, uncovered) if client_id is not None]
+        if not stops:
+            self.progress.done(self.index, len(self.clients) + self.skipped, self.sent)
+            return
+        self.mailing.run_finished = False
+        processed = bisect_left(self.client_ids, min(stops))
+        self.progress.done(self.index, processed, self.sent, self.client_ids[processed - 1] if processed else 0)
+
+    def defer(self, processed, sent):
+        """Отмечает, что отправка пачки прервалась после processed клиентов, остальные получат письмо позже"""
+        self.sent = sent
+        self.mailing.run_finished = False
+        self.stopped_at = self.clients[processed]['pk']
+        self.done()
+
+
+def iter_batches(mailing, progress, batch_size, limit):
+    """Пачки необработанных клиентов рассылки, клиенты каждой пачки выбираются из базы, когда до нее дошла очередь"""
+    for clients in get_recipient_pages(mailing, progress.checkpoint.last_client_id, batch_size, limit):
+        yield Batch(mailing, progress, clients)
+
+
+def plan_batches(mailings, batch_size=None, now=None):
+    """Разбивает необработанных клиентов рассылок на пачки и упорядочивает их по весам владельцев.
+
+    Если у рассылки задано окно распределения, в пачки попадают только клиенты,
+    чья очередь уже наступила, а у рассылки выставляется run_finished = False:
+    остальные клиенты получат письмо на следующих запусках, с контрольной точки.
+    Возвращает генератор пачек в порядке отправки и словарь {рассылка: писем, отправленных до падения}.
+    Клиенты заранее только подсчитываются, а выбираются по одной пачке, когда генератор до нее доходит.
+    Контрольные точки и количество клиентов всех рассылок читаются общими запросами,
+    их число не зависит ни от количества рассылок, ни от количества клиентов.
+    Клиенты, которым одно и то же письмо отправляют несколько рассылок, получают его один раз (main.coalescing).
+    """
+    batch_size = batch_size or settings.DISPATCH_BATCH_SIZE
+    now = now or timezone.now()
+    checkpoints = load_checkpoints(mailings)
+    after = {mailing_id: checkpoint.last_client_id for mailing_id, checkpoint in checkpoints.items()}
+    remaining = count_recipients_by_mailing(after)
+    streams, results = [], {}
+    for mailing in mailings:
+        progress = RunProgress(mailing, checkpoints[mailing.pk])
+        results[mailing] = progress.sent
+        processed = progress.checkpoint.processed
+        total = processed + remaining.get(mailing.pk, 0)
+        allowed = get_allowed_count(total, mailing.next_time, now, get_spread_window(mailing))
+        mailing.run_finished = allowed >= total
+        if allowed > processed:
+            streams.append((mailing.owner_id, iter_batches(mailing, progress, batch_size, allowed - processed)))
+    coalescer.plan(mailings, after)
+    weights = get_owner_weights(mailing.owner_id for mailing in mailings)
+    return weighted_round_robin(streams, weights), results
+
+
+class DispatchExecutor:
+    """Пул потоков для параллельной отправки рассылок.
+
+    Клиенты каждой рассылки разбиваются на пачки, пачки всех рассылок
+    отправляются параллельно, каждая пачка через свое SMTP-соединение.
+    Количество соединений с каждым SMTP-сервером ограничивает пул серверов (main.relays).
+    Пачки ставятся в очередь пула в порядке взвешенного обхода владельцев по мере освобождения потоков,
+    поэтому в памяти только клиенты выполняющихся и ожидающих в очереди пачек.
+    """
+
+    def __init__(self, pool_size=None, batch_size=None):
+        self.pool_size = pool_size or settings.DISPATCH_POOL_SIZE
+        self.batch_size = batch_size or settings.DISPATCH_BATCH_SIZE
+
+    def _run_batch(self, send_batch, batch):
+        try:
+            batch.sent = send_batch(batch.mailing, batch.clients)
+            batch.done()
+            return batch.sent
+        except CircuitOpenError as error:
+            batch.defer(error.processed, error.sent)
+            return batch.sent
+        finally:
+            # у каждого потока свое соединение с базой, закрываем его по завершении пачки
+            connections.close_all()
+
+    def dispatch(self, mailings, send_batch):
+        """Отправляет рассылки пачками, возвращает словарь {рассылка: количество отправленных писем}"""
+        batches, results = plan_batches(mailings, self.batch_size)
+        with ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='dispatch') as pool:
+            futures = {}
+            for batch in batches:
+                if len(futures) >= self.pool_size * 2:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[futures.pop(future).mailing] += future.result()
+                futures[pool.submit(self._run_batch, send_batch, batch)] = batch
+            for future in as_completed(futures):
+                results[futures[future].mailing] += future.result()
+        coalescer.finish()
+        return results
@@ -0,0 +1,35 @@
+from collections import deque
+
+from users.models import User
+
+
+def get_owner_weights(owner_ids):
+    """Веса владельцев рассылок при распределении отправки"""
+    return dict(User.objects.filter(pk__in=set(owner_ids)).values_list('pk', 'dispatch_weight'))
+
+
+def weighted_round_robin(streams, weights):
+    """Упорядочивает пачки взвешенным циклическим обходом владельцев.
+
+    streams - пары (владелец, итератор пачек одной рассылки), пачки берутся из итераторов
+    по мере обхода. За один круг владелец получает столько пачек, каков его вес, а пачки одного
+    владельца по очереди берутся из разных его рассылок. Так огромная рассылка одного
+    пользователя не задерживает небольшие рассылки остальных.
+    """
+    owners = {}
+    for owner_id, stream in streams:
+        owners.setdefault(owner_id, deque()).append(iter(stream))
+    while owners:
+        for owner_id in list(owners):
+            queues = owners[owner_id]
+            taken = 0
+            while queues and taken < max(weights.get(owner_id, 1), 1):
+                queue = queues.popleft()
+                batch = next(queue, None)
+                if batch is None:
+                    continue
+                yield batch
+                taken += 1
+                queues.append(queue)
+            if not queues:
+                del owners[owner_id]
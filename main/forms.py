@@ -1,6 +1,7 @@
 from django import forms
 
 from main.models import Client, Message, Mailing
+from main.personalization import FIELDS, get_unknown_placeholders
 
 
 class StyleFormMixin:
@@ -26,9 +27,33 @@ class MessageForm(StyleFormMixin, forms.ModelForm):
         model = Message
         exclude = ('owner',)
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        placeholders = ', '.join('{{ %s }}' % field for field in FIELDS)
+        self.fields['text'].help_text = f'Можно использовать данные клиента: {placeholders}'
+
+    def check_placeholders(self, field_name):
+        value = self.cleaned_data[field_name]
+        unknown = get_unknown_placeholders(value)
+        if unknown:
+            raise forms.ValidationError(f'Неизвестные подстановки: {", ".join(unknown)}')
+        return value
+
+    def clean_title(self):
+        return self.check_placeholders('title')
+
+    def clean_text(self):
+        return self.check_placeholders('text')
+
 
 class MailingForm(StyleFormMixin, forms.ModelForm):
 
     class Meta:
         model = Mailing
-        exclude = ('owner', 'status', 'next_time',)
+        exclude = ('owner', 'status', 'next_time', 'locked_by', 'locked_until',)
+
+    def save(self, commit=True):
+        # при изменении времени начала следующая отправка переносится на новое время
+        if 'start_time' in self.changed_data:
+            self.instance.next_time = self.instance.start_time
+        return super().save(commit)
@@ -0,0 +1,119 @@
+import logging
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connection
+
+# ключ advisory-блокировки, которую держит лидер планировщика
+LOCK_KEY = zlib.crc32(b'mailing_manager.runscheduler')
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """Выбор лидера среди процессов планировщика через advisory-блокировку PostgreSQL.
+
+    Лидер держит сессионную блокировку pg_try_advisory_lock на отдельном соединении и раз
+    в heartbeat секунд проверяет это соединение запросом. Блокировка снимается вместе с сессией:
+    при завершении или падении лидера - сразу, при зависании процесса или обрыве сети - через
+    timeout секунд (idle_session_timeout и TCP keepalive сессии на сервере). Резервные процессы
+    пробуют взять блокировку каждые heartbeat секунд и подхватывают работу за несколько секунд.
+    """
+
+    def __init__(self, key=LOCK_KEY, heartbeat=None, timeout=None):
+        self.key = key
+        self.heartbeat = heartbeat or settings.SCHEDULER_LEADER_HEARTBEAT
+        self.timeout = timeout or settings.SCHEDULER_LEADER_TIMEOUT
+        if self.heartbeat >= self.timeout:
+            raise ValueError('SCHEDULER_LEADER_HEARTBEAT должен быть меньше SCHEDULER_LEADER_TIMEOUT')
+        self.connection = None
+        self.is_leader = False
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        if connection.vendor != 'postgresql':
+            raise RuntimeError('выбор лидера планировщика работает только с PostgreSQL')
+        lock_connection = connection.get_new_connection(connection.get_connection_params())
+        lock_connection.autocommit = True
+        count = max(self.timeout // self.heartbeat, 1)
+        with lock_connection.cursor() as cursor:
+            # сервер обрывает сессию, по которой дольше timeout нет ни запросов, ни ответов на keepalive
+            cursor.execute(f'SET tcp_keepalives_idle = {self.heartbeat}')
+            cursor.execute(f'SET tcp_keepalives_interval = {self.heartbeat}')
+            cursor.execute(f'SET tcp_keepalives_count = {count}')
+            try:
+                cursor.execute(f'SET idle_session_timeout = {self.timeout * 1000}')
+            except connection.Database.Error:
+                # PostgreSQL до 14 версии: зависший лидер держит блокировку, пока жив его процесс
+                logger.warning('idle_session_timeout не поддерживается сервером, '
+                               'зависший лидер держит блокировку, пока жив его процесс')
+        return lock_connection
+
+    def close(self):
+        """Закрывает соединение с блокировкой, блокировка снимается сервером"""
+        self.is_leader = False
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except connection.Database.Error:
+                pass
+            self.connection = None
+
+    def try_acquire(self):
+        """Пробует стать лидером, возвращает True, если блокировка получена"""
+        try:
+            if self.connection is None:
+                self.connection = self._connect()
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT pg_try_advisory_lock(%s)', [self.key])
+                self.is_leader = cursor.fetchone()[0]
+        except connection.Database.Error as error:
+            logger.warning('Блокировка лидера недоступна: %s', error)
+            self.close()
+        return self.is_leader
+
+    def acquire(self):
+        """Ждет, пока процесс станет лидером"""
+        while not self.try_acquire():
+            if self._stopped.wait(self.heartbeat):
+                return False
+        return True
+
+    def is_alive(self):
+        """Heartbeat: сессия с блокировкой еще открыта, значит, блокировка у этого процесса"""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except connection.Database.Error as error:
+            logger.exception('Соединение с блокировкой лидера потеряно: %s', error)
+            return False
+
+    def _keep(self, on_lost):
+        while not self._stopped.wait(self.heartbeat):
+            if not self.is_alive():
+                self.close()
+                on_lost()
+                return
+
+    def keep(self, on_lost):
+        """Поддерживает лидерство в фоновом потоке, при потере блокировки вызывает on_lost"""
+        self._thread = threading.Thread(target=self._keep, args=(on_lost,), name='leader-heartbeat', daemon=True)
+        self._thread.start()
+
+    def release(self):
+        """Останавливает heartbeat и отдает лидерство"""
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self.is_leader:
+            try:
+                with self.connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', [self.key])
+            except connection.Database.Error:
+                pass
+        self.close()
+        self._stopped.clear()
@@ -0,0 +1,88 @@
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from main.models import Mailing
+from main.plan import MailingRecord
+
+
+def get_worker_id():
+    """Идентификатор процесса планировщика: имя хоста и pid"""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def claim_mailings(queryset, worker_id, limit=None, lease=None):
+    """Захватывает рассылки из queryset, не занятые другими процессами планировщика.
+
+    Строки блокируются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому параллельные
+    процессы разбирают разные рассылки без ожидания. Захват действует lease секунд,
+    после чего рассылку упавшего процесса может забрать другой.
+    Возвращает записи MailingRecord, прочитанные вместе с письмом тем же запросом.
+    """
+    limit = limit or settings.DISPATCH_CLAIM_LIMIT
+    lease = lease or settings.DISPATCH_LEASE_SECONDS
+    now = timezone.now()
+    locked_until = now + timedelta(seconds=lease)
+    with transaction.atomic():
+        mailings = [
+            MailingRecord(values) for values in
+            queryset.filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+            .select_for_update(skip_locked=True, of=('self',))
+            .order_by('next_time')
+            .values_list(*MailingRecord.COLUMNS)[:limit]
+        ]
+        Mailing.objects.filter(pk__in=[mailing.pk for mailing in mailings]).update(
+            locked_by=worker_id, locked_until=locked_until
+        )
+    for mailing in mailings:
+        mailing.locked_by, mailing.locked_until = worker_id, locked_until
+    return mailings
+
+
+def release_mailings(mailings, worker_id):
+    """Освобождает рассылки, захваченные процессом worker_id"""
+    Mailing.objects.filter(pk__in=[mailing.pk for mailing in mailings], locked_by=worker_id).update(
+        locked_by=None, locked_until=None
+    )
+
+
+class LeaseKeeper:
+    """Продлевает захват рассылок, пока идет их отправка.
+
+    Без продления долгая отправка большой рассылки пережила бы срок захвата,
+    и рассылку забрал бы другой процесс.
+    """
+
+    def __init__(self, mailings, worker_id, lease=None):
+        self.pks = [mailing.pk for mailing in mailings]
+        self.worker_id = worker_id
+        self.lease = lease or settings.DISPATCH_LEASE_SECONDS
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def renew(self):
+        Mailing.objects.filter(pk__in=self.pks, locked_by=self.worker_id).update(
+            locked_until=timezone.now() + timedelta(seconds=self.lease)
+        )
+
+    def _run(self):
+        try:
+            while not self._stopped.wait(self.lease / 3):
+                self.renew()
+        finally:
+            connections.close_all()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        self._thread.join()
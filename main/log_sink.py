@@ -0,0 +1,60 @@
+import threading
+import time
+
+from django.conf import settings
+
+from main.models import Log
+
+
+class LogSink:
+    """Буфер попыток отправки, сохраняемый в базу одним bulk_create.
+
+    Буфер сбрасывается при накоплении size записей, по прошествии interval секунд
+    с прошлого сброса, в конце каждого запуска рассылки и при остановке планировщика.
+    """
+
+    def __init__(self, size=None, interval=None):
+        self.size = size or settings.LOG_BUFFER_SIZE
+        self.interval = interval or settings.LOG_FLUSH_INTERVAL
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._flushed_at = time.monotonic()
+
+    def append(self, mailing, attempt_status, server_response):
+        """Добавляет попытку в буфер без сохранения в базу"""
+        log = Log(
+            last_attempt_time=mailing.start_time,
+            attempt_status=attempt_status,
+            server_response=server_response,
+            mailing_id=mailing.pk
+        )
+        with self._lock:
+            self._buffer.append(log)
+
+    def is_due(self):
+        """Проверяет, пора ли сбросить буфер"""
+        return len(self._buffer) >= self.size or time.monotonic() - self._flushed_at >= self.interval
+
+    def add(self, mailing, attempt_status, server_response):
+        """Добавляет попытку в буфер и сбрасывает его, если пора"""
+        self.append(mailing, attempt_status, server_response)
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        """Сохраняет накопленные попытки в базу, возвращает их количество"""
+        with self._lock:
+            logs, self._buffer = self._buffer, []
+            self._flushed_at = time.monotonic()
+        if logs:
+            try:
+                Log.objects.bulk_create(logs, batch_size=self.size)
+            except Exception:
+                # возвращаем записи в буфер, чтобы сохранить их при следующем сбросе
+                with self._lock:
+                    self._buffer[:0] = logs
+                raise
+        return len(logs)
+
+
+log_sink = LogSink()
@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+
+from main.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    """Команда для замера производительности отправки рассылок"""
+    help = 'Замер производительности рассылки на локальной SMTP-заглушке'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--count', type=int, help='Количество писем или объектов (по умолчанию - свое у сценария)')
+
+    def handle(self, *args, **options):
+        # без --count сценарий работает со своим объемом данных, например due_mailings - со 100 тысячами рассылок
+        kwargs = {} if options['count'] is None else {'count': options['count']}
+        report = SCENARIOS[options['scenario']](**kwargs)
+        for name, value in report.items():
+            self.stdout.write(f'{name}: {value}')
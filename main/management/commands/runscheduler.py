@@ -2,12 +2,16 @@ import logging
 
 from django.conf import settings
 
+from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 from django.core.management.base import BaseCommand
 from django_apscheduler.jobstores import DjangoJobStore
-from django_apscheduler.models import DjangoJobExecution
+from django_apscheduler.models import DjangoJob, DjangoJobExecution
 from django_apscheduler import util
+from main.leader import LeaderElection
+from main.log_sink import log_sink
+from main.next_fire import NextFireScheduler
 from main.services import my_job
 
 logger = logging.getLogger(__name__)
@@ -22,17 +26,47 @@ class Command(BaseCommand):
     help = 'Запускэ APScheduler'
 
     def handle(self, *args, **options):
-        scheduler = BlockingScheduler(timezone=settings.TIME_ZONE)
+        # с выбором лидера рассылки запускает только процесс, который держит блокировку лидера
+        election = LeaderElection() if settings.SCHEDULER_LEADER_ELECTION else None
+        try:
+            if election is None:
+                self.run_scheduler()
+            else:
+                logger.info('Ожидание лидерства...')
+                while election.acquire():
+                    logger.info('Процесс стал лидером планировщика.')
+                    self.run_scheduler(election)
+                    logger.info('Лидерство потеряно, ожидание лидерства...')
+        except KeyboardInterrupt:
+            log_sink.flush()
+            logger.info('Планировщик успешно завершает работу!')
+        finally:
+            if election is not None:
+                election.release()
+
+    def run_scheduler(self, election=None):
+        """Запускает планировщик; с выбором лидера - до потери лидерства"""
+        # в режиме event рассылки запускает NextFireScheduler, а APScheduler работает в фоне
+        event_mode = settings.SCHEDULER_MODE == 'event'
+        if event_mode:
+            scheduler = BackgroundScheduler(timezone=settings.TIME_ZONE)
+        else:
+            scheduler = BlockingScheduler(timezone=settings.TIME_ZONE)
         scheduler.add_jobstore(DjangoJobStore(), 'default')
 
-        scheduler.add_job(
-            my_job,
-            trigger=CronTrigger(minute='*/1'),
-            id='Запуск рассылки',
-            max_instances=1,
-            replace_existing=True,
-        )
-        logger.info("Добавлено задание 'Запуск рассылки'.")
+        if event_mode:
+            # задание от запуска в режиме cron сохранено в базе и не должно дублировать рассылку
+            DjangoJob.objects.filter(id='Запуск рассылки').delete()
+        else:
+            scheduler.add_job(
+                my_job,
+                trigger=CronTrigger(minute='*/1'),
+                id='Запуск рассылки',
+                max_instances=1,
+                coalesce=True,
+                replace_existing=True,
+            )
+            logger.info("Добавлено задание 'Запуск рассылки'.")
 
         scheduler.add_job(
             delete_old_job_executions,
@@ -47,10 +81,26 @@ class Command(BaseCommand):
             "Добавлено еженедельное задание: 'Удалить исполненные задачи'."
         )
 
+        next_fire = NextFireScheduler(my_job) if event_mode else None
+
+        def stop():
+            # начатый запуск рассылок доработает, повторно рассылки не отправятся благодаря их захвату (main.leases)
+            logger.info('Остановка планировщика: лидерство потеряно...')
+            if next_fire is not None:
+                next_fire.stop()
+            if scheduler.running:
+                scheduler.shutdown(wait=False)
+
+        if election is not None:
+            election.keep(on_lost=stop)
         try:
             logger.info('Запуск планировщика...')
             scheduler.start()
+            if event_mode:
+                logger.info('Запуск рассылок по ближайшему времени отправки...')
+                next_fire.run_forever()
         except KeyboardInterrupt:
             logger.info('Остановка планировщика...')
-            scheduler.shutdown()
-            logger.info('Планировщик успешно завершает работу!')
\ No newline at end of file
+            if scheduler.running:
+                scheduler.shutdown()
+            raise
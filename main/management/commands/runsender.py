@@ -0,0 +1,39 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from main.log_sink import log_sink
+from main.outbox import drain
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Команда для запуска отправителя писем из исходящей очереди"""
+    help = 'Отправка писем из исходящей очереди (DISPATCH_MODE=outbox)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Отправить очередь и завершить работу')
+
+    def handle(self, *args, **options):
+        logger.info('Запуск отправителя...')
+        try:
+            while True:
+                try:
+                    processed = drain()
+                except Exception:
+                    # база недоступна: повтор после паузы, захваченные доставки вернутся в очередь по истечении аренды
+                    logger.exception('Ошибка отправителя, повтор через %s с', settings.OUTBOX_POLL_INTERVAL)
+                    processed = 0
+                close_old_connections()
+                if not processed:
+                    if options['once']:
+                        break
+                    time.sleep(settings.OUTBOX_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            logger.info('Остановка отправителя...')
+        finally:
+            log_sink.flush()
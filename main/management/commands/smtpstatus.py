@@ -0,0 +1,21 @@
+from django.core.cache import cache
+from django.core.management import BaseCommand
+
+from main.breaker import get_state_key
+from main.relays import COUNTERS, get_counter_key, get_relays
+
+
+class Command(BaseCommand):
+    """Команда для просмотра состояния SMTP-серверов"""
+    help = ('Состояние предохранителей и счетчики писем SMTP-серверов, опубликованные планировщиком '
+            'и отправителями (нужен CACHE_ENABLED)')
+
+    def handle(self, *args, **options):
+        for relay in get_relays():
+            counters = ', '.join(f'{counter}: {cache.get(get_counter_key(relay.name, counter), 0)}'
+                                 for counter in COUNTERS)
+            state = cache.get(get_state_key(relay.name))
+            if state is None:
+                self.stdout.write(f'{relay.name}: предохранитель не срабатывал, {counters}')
+                continue
+            self.stdout.write(', '.join(f'{name}: {value}' for name, value in state.items()) + f', {counters}')
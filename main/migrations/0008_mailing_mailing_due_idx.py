@@ -0,0 +1,24 @@
+# Generated by Django 4.2 on 2026-10-18 12:36
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_next_time(apps, schema_editor):
+    Mailing = apps.get_model('main', 'Mailing')
+    Mailing.objects.filter(next_time__isnull=True).update(next_time=F('start_time'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_alter_mailing_options'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_next_time, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='mailing',
+            index=models.Index(fields=['is_active', 'status', 'next_time'], name='mailing_due_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 12:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_mailing_mailing_due_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='locked_by',
+            field=models.CharField(blank=True, max_length=150, null=True, verbose_name='Захвачена процессом'),
+        ),
+        migrations.AddField(
+            model_name='mailing',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Захвачена до'),
+        ),
+    ]
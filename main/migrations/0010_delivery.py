@@ -0,0 +1,39 @@
+# Generated by Django 4.2 on 2026-10-18 12:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_mailing_locked_by_mailing_locked_until'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_time', models.DateTimeField(verbose_name='Плановое время отправки')),
+                ('state', models.CharField(choices=[('Ожидает', 'Ожидает'), ('Отправлено', 'Отправлено'), ('Не доставлено', 'Не доставлено')], default='Ожидает', max_length=15, verbose_name='Состояние')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Количество попыток')),
+                ('next_attempt_time', models.DateTimeField(verbose_name='Время следующей попытки')),
+                ('last_error', models.TextField(blank=True, null=True, verbose_name='Последняя ошибка')),
+                ('client', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.client', verbose_name='Клиент')),
+                ('mailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.mailing', verbose_name='Рассылка')),
+            ],
+            options={
+                'verbose_name': 'Доставка',
+                'verbose_name_plural': 'Доставки',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(fields=['state', 'next_attempt_time'], name='delivery_due_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='delivery',
+            constraint=models.UniqueConstraint(fields=('mailing', 'client', 'run_time'), name='delivery_unique_run'),
+        ),
+    ]
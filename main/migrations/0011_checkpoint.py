@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 12:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_delivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_time', models.DateTimeField(verbose_name='Плановое время отправки')),
+                ('last_client_id', models.PositiveBigIntegerField(default=0, verbose_name='Последний обработанный клиент')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Обработано клиентов')),
+                ('sent', models.PositiveIntegerField(default=0, verbose_name='Отправлено писем')),
+                ('mailing', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.mailing', verbose_name='Рассылка')),
+            ],
+            options={
+                'verbose_name': 'Контрольная точка',
+                'verbose_name_plural': 'Контрольные точки',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='checkpoint',
+            constraint=models.UniqueConstraint(fields=('mailing', 'run_time'), name='checkpoint_unique_run'),
+        ),
+    ]
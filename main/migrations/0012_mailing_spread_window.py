@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailing',
+            name='spread_window',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Окно распределения отправки, минут'),
+        ),
+    ]
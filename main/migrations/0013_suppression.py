@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_mailing_spread_window'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=100, unique=True, verbose_name='Email')),
+                ('reason', models.CharField(choices=[('Недоставляемый адрес', 'Недоставляемый адрес'), ('Отписался', 'Отписался')], default='Недоставляемый адрес', max_length=50, verbose_name='Причина')),
+                ('server_response', models.TextField(blank=True, null=True, verbose_name='Ответ почтового сервера')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Добавлен')),
+            ],
+            options={
+                'verbose_name': 'Адрес в стоп-листе',
+                'verbose_name_plural': 'Стоп-лист',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_suppression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Bounce',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=100, unique=True, verbose_name='Email')),
+                ('count', models.PositiveIntegerField(default=0, verbose_name='Отказов за период')),
+                ('window_start', models.DateTimeField(verbose_name='Начало периода подсчета')),
+                ('server_response', models.TextField(blank=True, null=True, verbose_name='Последний ответ почтового сервера')),
+            ],
+            options={
+                'verbose_name': 'Отказы по адресу',
+                'verbose_name_plural': 'Отказы по адресам',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 13:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_bounce'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='delivery',
+            name='state',
+            field=models.CharField(choices=[('Ожидает', 'Ожидает'), ('Отправлено', 'Отправлено'), ('Не доставлено', 'Не доставлено'), ('Отменено', 'Отменено')], default='Ожидает', max_length=15, verbose_name='Состояние'),
+        ),
+    ]
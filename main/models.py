@@ -67,15 +67,26 @@ class Mailing(models.Model):
     clients = models.ManyToManyField(Client, verbose_name='Клиенты рассылки')
     letter = models.ForeignKey(Message, **NULLABLE, on_delete=models.SET_NULL, verbose_name='Письмо')
     owner = models.ForeignKey(User, on_delete=models.SET_NULL, **NULLABLE, verbose_name='Пользователь')
+    spread_window = models.PositiveIntegerField(**NULLABLE, verbose_name='Окно распределения отправки, минут')
+    locked_by = models.CharField(max_length=150, **NULLABLE, verbose_name='Захвачена процессом')
+    locked_until = models.DateTimeField(**NULLABLE, verbose_name='Захвачена до')
 
     def __str__(self):
         return f'time: {self.start_time}, periodicity: {self.periodicity}, status: {self.status}'
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.next_time is None:
+            self.next_time = self.start_time
+        super().save(*args, **kwargs)
+
     class Meta:
         verbose_name = 'Настройка рассылки'
         verbose_name_plural = 'Настройки рассылки'
 
         permissions = [('set_inactive', 'Can block mailing')]
+        indexes = [
+            models.Index(fields=['is_active', 'status', 'next_time'], name='mailing_due_idx'),
+        ]
 
 
 class Log(models.Model):
@@ -98,3 +109,101 @@ class Log(models.Model):
     class Meta:
         verbose_name = 'Попытка отправки'
         verbose_name_plural = 'Попытки отправки'
+
+
+class Delivery(models.Model):
+    """Модель Доставка письма рассылки клиенту (исходящая очередь)"""
+    PENDING = 'Ожидает'
+    SENT = 'Отправлено'
+    FAILED = 'Не доставлено'
+    CANCELLED = 'Отменено'
+    STATE_CHOICES = (
+        (PENDING, 'Ожидает'),
+        (SENT, 'Отправлено'),
+        (FAILED, 'Не доставлено'),
+        (CANCELLED, 'Отменено'),
+    )
+
+    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, verbose_name='Рассылка')
+    client = models.ForeignKey(Client, on_delete=models.CASCADE, verbose_name='Клиент')
+    run_time = models.DateTimeField(verbose_name='Плановое время отправки')
+    state = models.CharField(max_length=15, default=PENDING, choices=STATE_CHOICES, verbose_name='Состояние')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Количество попыток')
+    next_attempt_time = models.DateTimeField(verbose_name='Время следующей попытки')
+    last_error = models.TextField(**NULLABLE, verbose_name='Последняя ошибка')
+
+    def __str__(self):
+        return f'{self.mailing_id} -> {self.client_id}: {self.state}'
+
+    class Meta:
+        verbose_name = 'Доставка'
+        verbose_name_plural = 'Доставки'
+
+        constraints = [
+            models.UniqueConstraint(fields=['mailing', 'client', 'run_time'], name='delivery_unique_run'),
+        ]
+        indexes = [
+            models.Index(fields=['state', 'next_attempt_time'], name='delivery_due_idx'),
+        ]
+
+
+class Checkpoint(models.Model):
+    """Модель Контрольная точка запуска рассылки (последний обработанный клиент)"""
+    mailing = models.ForeignKey(Mailing, on_delete=models.CASCADE, verbose_name='Рассылка')
+    run_time = models.DateTimeField(verbose_name='Плановое время отправки')
+    last_client_id = models.PositiveBigIntegerField(default=0, verbose_name='Последний обработанный клиент')
+    processed = models.PositiveIntegerField(default=0, verbose_name='Обработано клиентов')
+    sent = models.PositiveIntegerField(default=0, verbose_name='Отправлено писем')
+
+    def __str__(self):
+        return f'{self.mailing_id} ({self.run_time}): {self.last_client_id}'
+
+    class Meta:
+        verbose_name = 'Контрольная точка'
+        verbose_name_plural = 'Контрольные точки'
+
+        constraints = [
+            models.UniqueConstraint(fields=['mailing', 'run_time'], name='checkpoint_unique_run'),
+        ]
+
+
+class Suppression(models.Model):
+    """Модель Адрес в стоп-листе: письма на него не отправляются"""
+    BOUNCE = 'Недоставляемый адрес'
+    UNSUBSCRIBED = 'Отписался'
+    REASON_CHOICES = (
+        (BOUNCE, 'Недоставляемый адрес'),
+        (UNSUBSCRIBED, 'Отписался'),
+    )
+
+    email = models.EmailField(max_length=100, unique=True, verbose_name='Email')
+    reason = models.CharField(max_length=50, default=BOUNCE, choices=REASON_CHOICES, verbose_name='Причина')
+    server_response = models.TextField(**NULLABLE, verbose_name='Ответ почтового сервера')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Добавлен')
+
+    def __str__(self):
+        return f'{self.email}: {self.reason}'
+
+    def save(self, *args, **kwargs):
+        # адреса сравниваются без учета регистра
+        self.email = self.email.strip().lower()
+        super().save(*args, **kwargs)
+
+    class Meta:
+        verbose_name = 'Адрес в стоп-листе'
+        verbose_name_plural = 'Стоп-лист'
+
+
+class Bounce(models.Model):
+    """Модель Счетчик постоянных отказов сервера по адресу за период подсчета"""
+    email = models.EmailField(max_length=100, unique=True, verbose_name='Email')
+    count = models.PositiveIntegerField(default=0, verbose_name='Отказов за период')
+    window_start = models.DateTimeField(verbose_name='Начало периода подсчета')
+    server_response = models.TextField(**NULLABLE, verbose_name='Последний ответ почтового сервера')
+
+    def __str__(self):
+        return f'{self.email}: {self.count}'
+
+    class Meta:
+        verbose_name = 'Отказы по адресу'
+        verbose_name_plural = 'Отказы по адресам'
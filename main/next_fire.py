@@ -0,0 +1,231 @@
+import heapq
+import logging
+import select
+import socket
+import threading
+import time
+from contextlib import suppress
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from main.models import Mailing
+
+CHANNEL = 'mailing_changed'
+
+logger = logging.getLogger(__name__)
+
+
+def get_fire_time(next_time, end_time):
+    """Время ближайшего события рассылки: следующей отправки или завершения, None - если событий нет"""
+    if next_time is None or end_time is None:
+        # рассылку без следующей отправки все равно нужно завершить в end_time
+        return next_time or end_time
+    return min(next_time, end_time)
+
+
+def notify_mailing_changed(pk):
+    """Сообщает планировщику об изменении рассылки через PostgreSQL NOTIFY.
+
+    Уведомление доставляется после фиксации транзакции, в которой изменилась рассылка.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, str(pk)])
+
+
+class NextFireQueue:
+    """Очередь ближайших событий рассылок на min-куче.
+
+    Устаревшие записи не удаляются из кучи сразу, а пропускаются при чтении.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._times = {}
+
+    def __len__(self):
+        return len(self._times)
+
+    def push(self, pk, fire_time):
+        self._times[pk] = fire_time
+        heapq.heappush(self._heap, (fire_time, pk))
+
+    def discard(self, pk):
+        self._times.pop(pk, None)
+
+    def clear(self):
+        self._heap = []
+        self._times = {}
+
+    def peek(self):
+        """Возвращает время ближайшего события или None, если очередь пуста"""
+        while self._heap and self._times.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Извлекает рассылки, время события которых наступило"""
+        due = []
+        while (fire_time := self.peek()) is not None and fire_time <= now:
+            _, pk = heapq.heappop(self._heap)
+            del self._times[pk]
+            due.append(pk)
+        return due
+
+
+class NextFireScheduler:
+    """Планировщик, который спит ровно до ближайшего события рассылки.
+
+    Вместо опроса базы раз в минуту держит в памяти очередь событий и пересчитывает
+    только изменившиеся рассылки, о которых узнает через LISTEN/NOTIFY.
+    На других СУБД, а также для страховки, очередь полностью перестраивается
+    раз в resync_interval секунд.
+    Ошибки запуска и обращения к базе записываются в лог и не останавливают планировщик:
+    упавший запуск повторяется через retry_interval секунд, а при обрыве соединения LISTEN
+    очередь перестраивается и подписка на изменения восстанавливается.
+    """
+
+    def __init__(self, job, retry_interval=None, resync_interval=None):
+        self.job = job
+        self.retry_interval = retry_interval or settings.NEXT_FIRE_RETRY_INTERVAL
+        self.resync_interval = resync_interval or settings.NEXT_FIRE_RESYNC_INTERVAL
+        self.queue = NextFireQueue()
+        self._changed = set()
+        self._stopped = threading.Event()
+        self._listener = None
+        self._resync = True
+        # пара сокетов, через которую stop() будит ожидание уведомлений в select
+        self._wakeup = None
+
+    def _mailings(self):
+        return Mailing.objects.filter(is_active=True).exclude(status=Mailing.COMPLETED)
+
+    def rebuild(self):
+        """Полностью перестраивает очередь событий"""
+        self.queue.clear()
+        for pk, next_time, end_time in self._mailings().values_list('pk', 'next_time', 'end_time'):
+            fire_time = get_fire_time(next_time, end_time)
+            if fire_time is not None:
+                self.queue.push(pk, fire_time)
+
+    def refresh(self, pks, not_before=None):
+        """Пересчитывает события указанных рассылок.
+
+        not_before откладывает рассылки, событие которых после запуска так и не сдвинулось.
+        """
+        pks = set(pks)
+        for pk in pks:
+            self.queue.discard(pk)
+        mailings = self._mailings().filter(pk__in=pks).values_list('pk', 'next_time', 'end_time')
+        for pk, next_time, end_time in mailings:
+            fire_time = get_fire_time(next_time, end_time)
+            if fire_time is None:
+                continue
+            if not_before is not None:
+                fire_time = max(fire_time, not_before)
+            self.queue.push(pk, fire_time)
+
+    def run_pending(self):
+        """Запускает задачу, если наступило время хотя бы одного события"""
+        now = timezone.now()
+        due = self.queue.pop_due(now)
+        if due:
+            try:
+                self.job()
+            except Exception:
+                logger.exception('Ошибка запуска рассылок, повтор через %s с', self.retry_interval)
+            self.refresh(due, not_before=now + timedelta(seconds=self.retry_interval))
+        return due
+
+    def _listen(self):
+        if connection.vendor != 'postgresql':
+            return None
+        try:
+            listener = connection.get_new_connection(connection.get_connection_params())
+            listener.autocommit = True
+            with listener.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+        except Exception:
+            logger.exception('Не удалось подписаться на изменения рассылок, очередь перестраивается раз в %s с',
+                             self.resync_interval)
+            return None
+        return listener
+
+    def _close_listener(self):
+        if self._listener is not None:
+            with suppress(Exception):
+                self._listener.close()
+            self._listener = None
+
+    def _wait(self, timeout):
+        if self._listener is None:
+            self._stopped.wait(timeout)
+            return
+        try:
+            ready, _, _ = select.select([self._listener, self._wakeup[0]], [], [], timeout)
+            if self._listener in ready:
+                self._listener.poll()
+                while self._listener.notifies:
+                    self._changed.add(int(self._listener.notifies.pop(0).payload))
+        except Exception:
+            # уведомления могли потеряться: переподключаемся и перестраиваем очередь
+            logger.exception('Соединение LISTEN потеряно')
+            self._close_listener()
+            self._resync = True
+
+    def get_timeout(self):
+        """Время сна в секундах до ближайшего события, но не дольше resync_interval"""
+        fire_time = self.queue.peek()
+        if fire_time is None:
+            return self.resync_interval
+        return min(max((fire_time - timezone.now()).total_seconds(), 0), self.resync_interval)
+
+    def _sync(self, resynced_at):
+        """Перестраивает очередь раз в resync_interval секунд или после сбоя, иначе пересчитывает изменившиеся
+        рассылки; возвращает время последнего перестроения"""
+        if self._resync or time.monotonic() - resynced_at >= self.resync_interval:
+            if self._listener is None:
+                self._listener = self._listen()
+            self._changed.clear()
+            self.rebuild()
+            self._resync = False
+            return time.monotonic()
+        if self._changed:
+            changed, self._changed = self._changed, set()
+            self.refresh(changed)
+        return resynced_at
+
+    def run_forever(self):
+        self._resync = True
+        self._wakeup = socket.socketpair()
+        resynced_at = time.monotonic()
+        try:
+            while not self._stopped.is_set():
+                try:
+                    resynced_at = self._sync(resynced_at)
+                    self.run_pending()
+                except Exception:
+                    # база недоступна: соединение с ошибкой закроется, очередь перестроится при следующей попытке
+                    logger.exception('Ошибка планировщика рассылок, повтор через %s с', self.retry_interval)
+                    self._resync = True
+                    close_old_connections()
+                    self._stopped.wait(self.retry_interval)
+                    continue
+                self._wait(self.get_timeout())
+                close_old_connections()
+        finally:
+            self._close_listener()
+            wakeup, self._wakeup = self._wakeup, None
+            for sock in wakeup:
+                sock.close()
+
+    def stop(self):
+        """Останавливает планировщик, не дожидаясь конца ожидания следующего события"""
+        self._stopped.set()
+        wakeup = self._wakeup
+        if wakeup is not None:
+            with suppress(OSError):
+                wakeup[1].send(b'\0')
@@ -0,0 +1,204 @@
+import logging
+import random
+from operator import itemgetter
+from datetime import timedelta
+from smtplib import SMTPException, SMTPRecipientsRefused
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from main.breaker import CircuitOpenError
+from main.log_sink import log_sink
+from main.models import Delivery
+from main.executor import chunked
+from main.payload import get_envelope_size, get_message_template
+from main.personalization import count_recipients, get_client_pages, get_recipient_row
+from main.ratelimit import rate_limiter
+from main.relays import get_relay_pool
+from main.spreading import get_offset, get_spread_window
+from main.suppression import is_hard_bounce, suppression_list
+from main.transport import SMTPSession
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_mailing(mailing, run_time=None):
+    """Ставит в исходящую очередь по одной доставке на каждого клиента рассылки.
+
+    Повторная постановка того же запуска рассылки не создает дублей, поэтому после
+    падения планировщика запуск можно безопасно поставить в очередь заново.
+    При заданном окне распределения время первой попытки каждого клиента сдвигается внутри окна.
+    Доставки создаются по страницам клиентов, в памяти одновременно одна страница.
+    Клиентам с адресами из стоп-листа доставки не создаются.
+    """
+    run_time = run_time or mailing.next_time
+    window = get_spread_window(mailing)
+    start = max(run_time, timezone.now())
+    total = count_recipients(mailing)
+    index = 0
+    for page in get_client_pages(mailing, ('email',), page_size=settings.OUTBOX_BATCH_SIZE):
+        deliveries = []
+        # позиции в окне распределения считаются по всем клиентам, как и total
+        kept = set(suppression_list.exclude(page, key=itemgetter(1)))
+        for index, (client_id, email) in enumerate(page, index):
+            if (client_id, email) not in kept:
+                continue
+            offset = get_offset(index, total, client_id, window)
+            deliveries.append(Delivery(mailing_id=mailing.pk, client_id=client_id, run_time=run_time,
+                                       next_attempt_time=start + timedelta(seconds=offset)))
+        Delivery.objects.bulk_create(deliveries, ignore_conflicts=True)
+        index += 1
+    return index
+
+
+def get_backoff(attempts):
+    """Задержка перед следующей попыткой: экспоненциально растет с каждой неудачей, со случайным разбросом"""
+    delay = min(settings.OUTBOX_RETRY_BASE * 2 ** (attempts - 1), settings.OUTBOX_RETRY_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.0))
+
+
+def fail_delivery(delivery, error):
+    """Засчитывает доставке неудачную попытку: откладывает ее до следующей или, если попытки исчерпаны,
+    помечает недоставленной"""
+    delivery.last_error = str(error)
+    if delivery.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        delivery.state = Delivery.FAILED
+    else:
+        delivery.next_attempt_time = timezone.now() + get_backoff(delivery.attempts)
+
+
+def close_deliveries(now):
+    """Закрывает доставки, время попытки которых наступило, но отправлять которые уже нельзя.
+
+    Доставки заблокированной рассылки и рассылки, письмо которой удалено, отменяются. Доставки,
+    исчерпавшие OUTBOX_MAX_ATTEMPTS попыток (например, отправитель падал, не сохранив результат),
+    считаются недоставленными.
+    """
+    due = Delivery.objects.filter(state=Delivery.PENDING, next_attempt_time__lte=now)
+    due.filter(attempts__gte=settings.OUTBOX_MAX_ATTEMPTS).update(
+        state=Delivery.FAILED, last_error='Исчерпаны попытки отправки'
+    )
+    due.filter(Q(mailing__is_active=False) | Q(mailing__letter__isnull=True)).update(
+        state=Delivery.CANCELLED, last_error='Рассылка заблокирована или письмо удалено'
+    )
+
+
+def claim_deliveries(limit=None, lease=None):
+    """Захватывает пачку доставок, время попытки которых наступило.
+
+    Время следующей попытки сразу сдвигается на lease секунд: если отправитель упадет,
+    доставка снова станет доступна другим отправителям по истечении этого срока.
+    Доставки, которые отправлять уже нельзя, перед захватом закрываются (close_deliveries).
+    """
+    limit = limit or settings.OUTBOX_BATCH_SIZE
+    lease = lease or settings.OUTBOX_LEASE_SECONDS
+    now = timezone.now()
+    with transaction.atomic():
+        close_deliveries(now)
+        pks = list(
+            Delivery.objects.filter(state=Delivery.PENDING, next_attempt_time__lte=now,
+                                    attempts__lt=settings.OUTBOX_MAX_ATTEMPTS,
+                                    mailing__is_active=True, mailing__letter__isnull=False)
+            # блокируются только строки доставок, рассылки остаются доступны
+            .select_for_update(skip_locked=True, of=('self',))
+            .order_by('next_attempt_time')
+            .values_list('pk', flat=True)[:limit]
+        )
+        Delivery.objects.filter(pk__in=pks).update(
+            attempts=F('attempts') + 1, next_attempt_time=now + timedelta(seconds=lease)
+        )
+    return list(Delivery.objects.filter(pk__in=pks).select_related('mailing__letter', 'client'))
+
+
+def send_deliveries(deliveries):
+    """Отправляет пачку доставок через одно SMTP-соединение и сохраняет результаты.
+
+    Доставки рассылки без подстановок отправляются одной SMTP-транзакцией по EMAIL_ENVELOPE_SIZE,
+    отказ сервера по отдельному адресу засчитывается только доставке этого клиента,
+    постоянные отказы учитываются в стоп-листе.
+    Если срабатывает предохранитель SMTP-сервера, оставшиеся доставки откладываются
+    до его следующей пробы, и попытка им не засчитывается. Если письмо для части доставок
+    не удалось собрать, неудачная попытка засчитывается только им.
+    """
+    sent, failed, deferred = [], [], []
+    # письмо каждой рассылки собирается один раз на пачку
+    by_mailing = {}
+    for delivery in deliveries:
+        by_mailing.setdefault(delivery.mailing.pk, []).append(delivery)
+    envelopes = [
+        envelope
+        for group in by_mailing.values()
+        for envelope in chunked(group, get_envelope_size(group[0].mailing))
+    ]
+    bounces = []
+    with SMTPSession() as session:
+        for index, envelope in enumerate(envelopes):
+            mailing = envelope[0].mailing
+            try:
+                message = get_message_template(mailing).render_envelope(
+                    [get_recipient_row(delivery.client) for delivery in envelope]
+                )
+            except Exception as error:
+                logger.exception('Не удалось собрать письмо рассылки %s', mailing.pk)
+                for delivery in envelope:
+                    log_sink.add(mailing, 'Безуспешно', error)
+                    fail_delivery(delivery, error)
+                    failed.append(delivery)
+                continue
+            try:
+                rate_limiter.acquire(owner_id=mailing.owner_id, tokens=len(envelope))
+                session.send(message)
+                refused = message.refused
+            except CircuitOpenError as error:
+                deferred = [delivery for pending in envelopes[index:] for delivery in pending]
+                for delivery in deferred:
+                    delivery.attempts -= 1
+                    delivery.next_attempt_time = error.retry_at
+                break
+            except SMTPRecipientsRefused as error:
+                refused = error.recipients
+            except (SMTPException, OSError) as error:
+                refused = dict.fromkeys(message.recipients(), error)
+            for delivery, address in zip(envelope, message.recipients()):
+                if address not in refused:
+                    log_sink.add(mailing, 'Успешно', 1)
+                    sent.append(delivery.pk)
+                    continue
+                log_sink.add(mailing, 'Безуспешно', refused[address])
+                if is_hard_bounce(refused[address]):
+                    bounces.append((delivery.client.email, refused[address]))
+                fail_delivery(delivery, refused[address])
+                failed.append(delivery)
+    Delivery.objects.filter(pk__in=sent).update(state=Delivery.SENT, last_error=None)
+    Delivery.objects.bulk_update(failed, ['state', 'next_attempt_time', 'last_error'])
+    Delivery.objects.bulk_update(deferred, ['attempts', 'next_attempt_time'])
+    if bounces:
+        suppression_list.record_bounces(bounces)
+    return len(sent)
+
+
+def drain(limit=None):
+    """Отправляет одну пачку доставок из очереди, возвращает количество обработанных.
+
+    Если отправка пачки падает, ошибка записывается в лог, а всем доставкам пачки засчитывается
+    неудачная попытка, чтобы одна сломанная доставка не останавливала отправителя.
+    """
+    if not get_relay_pool().is_available():
+        return 0
+    deliveries = claim_deliveries(limit)
+    if deliveries:
+        try:
+            send_deliveries(deliveries)
+        except Exception as error:
+            logger.exception('Ошибка отправки пачки из %s доставок', len(deliveries))
+            # результаты, сохраненные до ошибки, не перезаписываются
+            pending = set(Delivery.objects.filter(pk__in=[delivery.pk for delivery in deliveries],
+                                                  state=Delivery.PENDING).values_list('pk', flat=True))
+            failed = [delivery for delivery in deliveries if delivery.pk in pending]
+            for delivery in failed:
+                fail_delivery(delivery, error)
+            Delivery.objects.bulk_update(failed, ['state', 'next_attempt_time', 'last_error'])
+        log_sink.flush()
+    return len(deliveries)
@@ -0,0 +1,156 @@
+import re
+from base64 import b64encode
+from binascii import b2a_qp
+from email.utils import formatdate, make_msgid
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.core.mail.message import sanitize_address
+from django.core.mail.utils import DNS_NAME
+
+from main.dkim import get_signer, split_message
+from main.personalization import compile_template
+
+# адрес из латиницы без имени получателя не требует кодирования, разбор sanitize_address для него не нужен
+PLAIN_ADDRESS = re.compile(r"[\w.!#$%&'*+/=?^`{|}~-]+@[a-z0-9.-]+", re.ASCII | re.IGNORECASE)
+LINE_BREAK = re.compile(r'\r\n|\r|\n')
+LINE_LENGTH_LIMIT = 998
+
+
+def encode_address(email, encoding):
+    """Адрес для заголовка и конверта письма"""
+    return email if PLAIN_ADDRESS.fullmatch(email) else sanitize_address(email, encoding)
+
+
+def encode_header(value):
+    """Значение заголовка: ASCII как есть, иначе encoded-word base64 (RFC 2047) частями по целым символам"""
+    if value.isascii() and len(value) < LINE_LENGTH_LIMIT - 20:
+        return value
+    words, chunk, size = [], [], 0
+    for char in value:
+        length = len(char.encode())
+        # 45 байт дают 60 символов base64, слово с обрамлением укладывается в 76 символов
+        if size + length > 45:
+            words.append(''.join(chunk))
+            chunk, size = [], 0
+        chunk.append(char)
+        size += length
+    words.append(''.join(chunk))
+    return '\r\n '.join(f'=?utf-8?b?{b64encode(word.encode()).decode()}?=' for word in words)
+
+
+class PreparedMessage:
+    """Готовое к отправке письмо: адреса конверта и сериализованный MIME.
+
+    После отправки в refused лежат отклоненные сервером получатели: {адрес: (код, ответ)}.
+    """
+
+    __slots__ = ('from_email', 'to', 'data', 'refused')
+
+    def __init__(self, from_email, to, data):
+        self.from_email = from_email
+        self.to = to
+        self.data = data
+        self.refused = {}
+
+    def recipients(self):
+        return self.to
+
+
+class MessageTemplate:
+    """Письмо рассылки, собранное один раз на запуск.
+
+    Без подстановок тема, тело и общие заголовки кодируются и сериализуются при создании шаблона,
+    для каждого получателя к ним дописываются только заголовки To, Date и Message-ID.
+    С подстановками тема и текст заполняются для получателя по разобранным шаблонам
+    и сериализуются напрямую, без сборки MIME через email.
+    С настроенным DKIM письмо подписывается, хеш тела без подстановок считается один раз на шаблон.
+    """
+
+    def __init__(self, subject, body, from_email=None):
+        message = EmailMessage(subject, body, from_email or settings.EMAIL_HOST_USER)
+        self.encoding = message.encoding or settings.DEFAULT_CHARSET
+        self.from_email = encode_address(message.from_email, self.encoding)
+        self.subject = compile_template(subject)
+        self.body = compile_template(body or '')
+        self.data = None
+        self.signer = get_signer()
+        self.body_hash = None
+        if self.subject.is_static and self.body.is_static:
+            self.data = self._build(message)
+            if self.signer is not None:
+                self.body_hash = self.signer.hash_body(split_message(self.data)[1])
+
+    @staticmethod
+    def _build(message):
+        mime = message.message()
+        del mime['Date']
+        del mime['Message-ID']
+        return mime.as_bytes(linesep='\r\n')
+
+    def serialize(self, subject, body):
+        """MIME письма с заполненными темой и текстом"""
+        if self.encoding.lower() != 'utf-8' or '\n' in subject or '\r' in subject:
+            # редкие случаи собирает Django, он же отклоняет переносы строк в теме
+            return self._build(EmailMessage(subject, body, self.from_email))
+        body = LINE_BREAK.sub('\r\n', body).encode()
+        if any(len(line) > LINE_LENGTH_LIMIT for line in body.split(b'\r\n')):
+            # как и Django, длинные строки кодируем quoted-printable
+            encoding, body = 'quoted-printable', b2a_qp(body, istext=True)
+        else:
+            encoding = '7bit' if body.isascii() else '8bit'
+        headers = (
+            'Content-Type: text/plain; charset="utf-8"\r\n'
+            'MIME-Version: 1.0\r\n'
+            f'Content-Transfer-Encoding: {encoding}\r\n'
+            f'Subject: {encode_header(subject)}\r\n'
+            f'From: {self.from_email}\r\n'
+            '\r\n'
+        )
+        return headers.encode('ascii') + body
+
+    @property
+    def is_static(self):
+        """Письмо одинаково для всех получателей"""
+        return self.data is not None
+
+    def _prepare(self, to, to_header, data):
+        headers = (
+            f'To: {to_header}\r\n'
+            f'Date: {formatdate(localtime=settings.EMAIL_USE_LOCALTIME)}\r\n'
+            f'Message-ID: {make_msgid(domain=DNS_NAME)}\r\n'
+        )
+        data = headers.encode('ascii') + data
+        if self.signer is not None:
+            data = self.signer.sign(data, self.body_hash) + data
+        return PreparedMessage(self.from_email, to, data)
+
+    def render(self, recipient):
+        """Письмо для одного получателя, recipient - строка values() клиента с полями для подстановки"""
+        to = encode_address(recipient['email'], self.encoding)
+        data = self.data or self.serialize(self.subject.render(recipient), self.body.render(recipient))
+        return self._prepare([to], to, data)
+
+    def render_envelope(self, recipients):
+        """Одно письмо сразу нескольким получателям (только без подстановок).
+
+        Получатели указываются только в конверте (RCPT TO), в заголовке To их адресов нет,
+        как при отправке в скрытой копии.
+        """
+        if len(recipients) == 1:
+            return self.render(recipients[0])
+        to = [encode_address(recipient['email'], self.encoding) for recipient in recipients]
+        return self._prepare(to, 'undisclosed-recipients:;', self.data)
+
+
+def get_message_template(mailing):
+    """Шаблон письма рассылки, собирается при первом обращении и хранится в объекте рассылки до конца запуска"""
+    template = getattr(mailing, 'message_template', None)
+    if template is None:
+        template = mailing.message_template = MessageTemplate(mailing.letter.title, mailing.letter.text)
+    return template
+
+
+def get_envelope_size(mailing):
+    """Сколько клиентов получают письмо рассылки одной SMTP-транзакцией: с подстановками - по одному"""
+    return max(settings.EMAIL_ENVELOPE_SIZE, 1) if get_message_template(mailing).is_static else 1
@@ -0,0 +1,130 @@
+import hashlib
+import re
+import threading
+
+from django.conf import settings
+from django.db.models import Count, Q
+
+from main.models import Mailing
+
+# поля клиента, доступные в теме и тексте письма как {{ first_name }}
+FIELDS = ('first_name', 'last_name', 'patronymic', 'email')
+NULLABLE_FIELDS = ('patronymic',)
+
+PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+class CompiledTemplate:
+    """Тема или текст письма с подстановками, разобранные один раз.
+
+    Шаблон превращается в строку для str.format_map, поэтому подстановка для получателя -
+    один вызов на C без разбора шаблона. Неизвестные подстановки остаются в тексте как есть.
+    """
+
+    __slots__ = ('source', 'fields', 'format')
+
+    def __init__(self, source):
+        self.source = source
+        self.fields = []
+        parts, position = [], 0
+        for match in PLACEHOLDER.finditer(source):
+            if match.group(1) not in FIELDS:
+                continue
+            parts.append(source[position:match.start()].replace('{', '{{').replace('}', '}}'))
+            parts.append('{%s}' % match.group(1))
+            self.fields.append(match.group(1))
+            position = match.end()
+        parts.append(source[position:].replace('{', '{{').replace('}', '}}'))
+        self.format = ''.join(parts)
+
+    @property
+    def is_static(self):
+        return not self.fields
+
+    def render(self, recipient):
+        """Текст для получателя, recipient - строка values() клиента с полями FIELDS"""
+        return self.format.format_map(recipient) if self.fields else self.source
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def compile_template(source):
+    """Разобранный шаблон из кеша процесса, ключ кеша - хеш текста шаблона"""
+    key = hashlib.blake2b(source.encode(), digest_size=16).digest()
+    template = _templates.get(key)
+    if template is None:
+        template = CompiledTemplate(source)
+        with _templates_lock:
+            if len(_templates) >= settings.MESSAGE_TEMPLATE_CACHE_SIZE:
+                _templates.clear()
+            _templates[key] = template
+    return template
+
+
+def get_unknown_placeholders(source):
+    """Подстановки, которых нет среди полей клиента"""
+    return sorted({name for name in PLACEHOLDER.findall(source or '') if name not in FIELDS})
+
+
+def get_client_pages(mailing, fields=(), after=0, page_size=None, limit=None):
+    """Клиенты рассылки страницами кортежей (pk, *fields) в порядке pk, начиная после клиента after.
+
+    Каждая страница - один запрос к таблице связи рассылки с клиентами по условию client_id > последнего
+    клиента предыдущей страницы (keyset, без OFFSET), из таблицы клиентов берутся только поля fields,
+    объекты модели не создаются. В памяти одновременно одна страница, сколько бы ни было клиентов.
+    limit - сколько всего клиентов выбрать.
+    """
+    page_size = page_size or settings.DISPATCH_BATCH_SIZE
+    through = Mailing.clients.through.objects.filter(mailing_id=mailing.pk).order_by('client_id')
+    columns = [f'client__{field}' for field in fields]
+    while limit is None or limit > 0:
+        size = page_size if limit is None else min(page_size, limit)
+        page = list(through.filter(client_id__gt=after).values_list('client_id', *columns)[:size])
+        if page:
+            yield page
+        if len(page) < size:
+            return
+        after = page[-1][0]
+        if limit is not None:
+            limit -= len(page)
+
+
+def get_recipient_pages(mailing, after=0, page_size=None, limit=None):
+    """Клиенты рассылки страницами строк с pk и полями для подстановки (см. get_client_pages)"""
+    for page in get_client_pages(mailing, FIELDS, after, page_size, limit):
+        rows = []
+        for values in page:
+            row = dict(zip(FIELDS, values[1:]), pk=values[0])
+            for field in NULLABLE_FIELDS:
+                if row[field] is None:
+                    row[field] = ''
+            rows.append(row)
+        yield rows
+
+
+def count_recipients_by_mailing(after):
+    """Количество клиентов нескольких рассылок одним запросом по таблице связи, без чтения клиентов.
+
+    after - {рассылка (pk): клиент, после которого считать}, возвращает {рассылка (pk): количество}.
+    """
+    condition = Q()
+    for mailing_id, client_id in after.items():
+        condition |= Q(mailing_id=mailing_id, client_id__gt=client_id)
+    if not condition:
+        return {}
+    return dict(
+        Mailing.clients.through.objects.filter(condition)
+        .values('mailing_id').annotate(count=Count('pk')).values_list('mailing_id', 'count')
+    )
+
+
+def count_recipients(mailing, after=0):
+    """Количество клиентов рассылки после клиента after"""
+    return count_recipients_by_mailing({mailing.pk: after}).get(mailing.pk, 0)
+
+
+def get_recipient_row(client):
+    """Строка для подстановки из объекта клиента"""
+    return {'pk': client.pk, **{field: getattr(client, field) or '' for field in FIELDS}}
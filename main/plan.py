@@ -0,0 +1,25 @@
+from collections import namedtuple
+
+Letter = namedtuple('Letter', 'title text')
+
+
+class MailingRecord:
+    """Рассылка в плане отправки запуска: только нужные для отправки поля рассылки и письма, без объекта модели.
+
+    Записи всех захваченных рассылок читаются одним запросом вместе с темой и текстом письма.
+    """
+
+    COLUMNS = ('id', 'owner_id', 'start_time', 'next_time', 'end_time', 'periodicity', 'spread_window',
+               'letter__title', 'letter__text')
+
+    __slots__ = ('pk', 'owner_id', 'start_time', 'next_time', 'end_time', 'periodicity', 'spread_window', 'letter',
+                 'locked_by', 'locked_until', 'run_finished', 'message_template')
+
+    def __init__(self, values):
+        (self.pk, self.owner_id, self.start_time, self.next_time, self.end_time, self.periodicity,
+         self.spread_window, title, text) = values
+        self.letter = Letter(title, text)
+        self.locked_by = self.locked_until = None
+
+    def __repr__(self):
+        return f'<MailingRecord {self.pk}>'
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# атомарное пополнение и списание токенов в Redis, время берется у сервера Redis,
+# чтобы расхождение часов на разных машинах не влияло на общий лимит
+REDIS_TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+-- запрос больше емкости корзины ждет полной корзины и уводит баланс в минус
+if tokens >= math.min(requested, capacity) then
+    tokens = tokens - requested
+else
+    wait = (math.min(requested, capacity) - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class TokenBucket:
+    """Ограничитель скорости «корзина токенов» в памяти процесса.
+
+    Токены пополняются со скоростью rate в секунду до capacity, на каждого получателя тратится один токен.
+    Запрос больше capacity (письмо сразу многим получателям) выполняется при полной корзине
+    и уводит баланс в минус, следующие запросы ждут, пока долг не восполнится.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Берет токены, если они есть, иначе возвращает время ожидания в секундах"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            required = min(tokens, self.capacity)
+            if self._tokens >= required:
+                self._tokens -= tokens
+                return 0
+            return (required - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Ждет, пока не получится взять токены"""
+        while (wait := self.reserve(tokens)) > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens=1):
+        """Асинхронно ждет, пока не получится взять токены"""
+        while (wait := self.reserve(tokens)) > 0:
+            await asyncio.sleep(wait)
+
+
+class RedisTokenBucket(TokenBucket):
+    """Корзина токенов в Redis, общая для всех процессов планировщика и отправителей"""
+
+    def __init__(self, key, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self.key = key
+        self._script = cache._cache.get_client(key, write=True).register_script(REDIS_TOKEN_BUCKET)
+
+    def reserve(self, tokens=1):
+        return float(self._script(keys=[self.key], args=[self.rate, self.capacity, tokens]))
+
+
+class RateLimiter:
+    """Ограничение скорости отправки по SMTP-серверу и по владельцу рассылки.
+
+    Письмо отправляется, только когда есть токен и в корзине сервера, и в корзине владельца.
+    С RATE_LIMIT_SHARED корзины хранятся в Redis (кеш проекта), и лимит общий для всех процессов.
+    """
+
+    def __init__(self, relay_rate=None, owner_rate=None, burst=None, shared=None):
+        self.relay_rate = settings.RATE_LIMIT_RELAY if relay_rate is None else relay_rate
+        self.owner_rate = settings.RATE_LIMIT_OWNER if owner_rate is None else owner_rate
+        self.burst = burst or settings.RATE_LIMIT_BURST
+        self.shared = settings.RATE_LIMIT_SHARED if shared is None else shared
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, name, rate):
+        with self._lock:
+            if name not in self._buckets:
+                capacity = max(rate * self.burst, 1)
+                if self.shared:
+                    self._buckets[name] = RedisTokenBucket(f'ratelimit:{name}', rate, capacity)
+                else:
+                    self._buckets[name] = TokenBucket(rate, capacity)
+            return self._buckets[name]
+
+    def get_buckets(self, relay=None, owner_id=None):
+        """Корзины, из которых нужно взять токены для отправки письма (нулевой лимит не ограничивает).
+
+        Лимит владельца проверяется до выбора SMTP-сервера, лимит сервера - когда сервер уже выбран.
+        """
+        buckets = []
+        if self.owner_rate and owner_id is not None:
+            buckets.append(self._bucket(f'owner:{owner_id}', self.owner_rate))
+        if self.relay_rate and relay is not None:
+            buckets.append(self._bucket(f'relay:{relay}', self.relay_rate))
+        return buckets
+
+    def acquire(self, relay=None, owner_id=None, tokens=1):
+        """Ждет токены для tokens получателей письма"""
+        for bucket in self.get_buckets(relay, owner_id):
+            bucket.acquire(tokens)
+
+    async def aacquire(self, relay=None, owner_id=None, tokens=1):
+        for bucket in self.get_buckets(relay, owner_id):
+            await bucket.aacquire(tokens)
+
+
+rate_limiter = RateLimiter()
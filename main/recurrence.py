@@ -0,0 +1,91 @@
+import calendar
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from main.models import Mailing
+
+# единица и шаг повторения для каждой периодичности
+PERIODS = {
+    Mailing.DAILY: ('days', 1),
+    Mailing.WEEKLY: ('days', 7),
+    Mailing.MONTHLY: ('months', 1),
+}
+
+SKIP = 'skip'
+COALESCE = 'coalesce'
+
+
+def add_months(value, months):
+    """Сдвигает дату на заданное количество календарных месяцев (31 января + 1 месяц = 28/29 февраля)"""
+    month_index = value.month - 1 + months
+    year, month = value.year + month_index // 12, month_index % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day)
+
+
+def _local(value, tz):
+    return timezone.localtime(value, tz).replace(tzinfo=None)
+
+
+def get_occurrence(anchor, periodicity, index, tz=None):
+    """Время index-го повторения рассылки, отсчитанное от anchor.
+
+    Повторения считаются в местном времени, поэтому рассылка на 09:00
+    остается на 09:00 и после перехода на летнее/зимнее время.
+    """
+    tz = tz or timezone.get_current_timezone()
+    unit, step = PERIODS[periodicity]
+    local = _local(anchor, tz)
+    if unit == 'months':
+        local = add_months(local, index * step)
+    else:
+        local += timedelta(days=index * step)
+    return timezone.make_aware(local, tz)
+
+
+def get_index_before(anchor, periodicity, moment, tz=None):
+    """Номер последнего повторения не позже moment, -1 если moment раньше anchor"""
+    tz = tz or timezone.get_current_timezone()
+    unit, step = PERIODS[periodicity]
+    local_anchor, local_moment = _local(anchor, tz), _local(moment, tz)
+    if unit == 'months':
+        index = ((local_moment.year - local_anchor.year) * 12 + local_moment.month - local_anchor.month) // step
+    else:
+        index = (local_moment - local_anchor).days // step
+    index = max(index, -1)
+    # поправка на короткие месяцы и переход на летнее/зимнее время, не больше пары шагов
+    while index >= 0 and get_occurrence(anchor, periodicity, index, tz) > moment:
+        index -= 1
+    while get_occurrence(anchor, periodicity, index + 1, tz) <= moment:
+        index += 1
+    return index
+
+
+def get_last_occurrence(anchor, periodicity, moment, tz=None):
+    """Последнее плановое время отправки не позже moment или None"""
+    if periodicity not in PERIODS:
+        return anchor if anchor <= moment else None
+    index = get_index_before(anchor, periodicity, moment, tz)
+    return get_occurrence(anchor, periodicity, index, tz) if index >= 0 else None
+
+
+def get_next_occurrence(anchor, periodicity, after, tz=None):
+    """Первое плановое время отправки строго позже after, None для разовой рассылки"""
+    if periodicity not in PERIODS:
+        return anchor if anchor > after else None
+    return get_occurrence(anchor, periodicity, get_index_before(anchor, periodicity, after, tz) + 1, tz)
+
+
+def is_missed(anchor, periodicity, now, policy=None, grace=None):
+    """Проверяет, что плановая отправка просрочена и по политике skip выполняться не должна.
+
+    При политике coalesce все пропущенные отправки объединяются в одну, которая выполняется сразу.
+    """
+    policy = policy or settings.MAILING_CATCHUP_POLICY
+    grace = settings.MAILING_CATCHUP_GRACE if grace is None else grace
+    if policy != SKIP:
+        return False
+    last = get_last_occurrence(anchor, periodicity, now)
+    return last is not None and (now - last).total_seconds() > grace
@@ -0,0 +1,151 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from main.breaker import CircuitOpenError, get_breaker
+
+WEIGHTED = 'weighted'
+LEAST = 'least'
+
+COUNTERS = ('sent', 'failed', 'failovers')
+
+
+class Relay:
+    """SMTP-сервер для отправки писем со своими учетными данными, весом и ограничением соединений"""
+
+    def __init__(self, host, port=None, username=None, password=None, use_tls=False, use_ssl=False,
+                 weight=1, concurrency=None, name=None):
+        self.name = name or host
+        self.host = host
+        self.port = int(port or 25)
+        self.username = username or ''
+        self.password = password or ''
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.weight = max(int(weight), 1)
+        # без явного ограничения: DISPATCH_HOST_CONCURRENCY соединений для пула потоков,
+        # DISPATCH_ASYNC_IN_FLIGHT для асинхронной отправки
+        self.concurrency = concurrency
+        self.breaker = get_breaker(self.name)
+        self.outstanding = 0
+        self.current_weight = 0
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    @classmethod
+    def from_backend_kwargs(cls, backend_kwargs):
+        """Сервер из параметров SMTP-бэкенда Django (host, port, username, password, use_tls, use_ssl)"""
+        return cls(**{key: value for key, value in backend_kwargs.items() if key != 'backend'})
+
+    def get_backend_kwargs(self):
+        """Параметры для get_connection"""
+        return {
+            'host': self.host,
+            'port': self.port,
+            'username': self.username,
+            'password': self.password,
+            'use_tls': self.use_tls,
+            'use_ssl': self.use_ssl,
+        }
+
+
+class RelayPool:
+    """Набор SMTP-серверов, между которыми распределяется отправка.
+
+    weighted - плавный взвешенный round-robin (как в nginx), least - сервер с наименьшим
+    числом выполняющихся отправок относительно веса. Серверы с открытым предохранителем
+    и уже отказавшие в текущей отправке пропускаются, так что письмо уходит через следующий сервер.
+    """
+
+    def __init__(self, relays, balancing=None):
+        self.relays = relays
+        self.balancing = balancing or settings.EMAIL_RELAY_BALANCING
+        self._lock = threading.Condition()
+
+    def is_available(self):
+        """Есть ли сервер, на который сейчас можно отправлять письма"""
+        return any(relay.breaker.is_available() for relay in self.relays)
+
+    def get_open_error(self):
+        """Ошибка для случая, когда предохранители всех серверов открыты"""
+        breakers = [relay.breaker for relay in self.relays if relay.breaker.retry_at]
+        return CircuitOpenError(min(breakers, key=lambda breaker: breaker.retry_at))
+
+    def _choose(self, relays):
+        if self.balancing == LEAST:
+            return min(relays, key=lambda relay: relay.outstanding / relay.weight)
+        total = sum(relay.weight for relay in relays)
+        for relay in relays:
+            relay.current_weight += relay.weight
+        chosen = max(relays, key=lambda relay: relay.current_weight)
+        chosen.current_weight -= total
+        return chosen
+
+    def acquire(self, exclude=(), limited=True):
+        """Выбирает сервер и занимает на нем место, None - если подходящих серверов нет.
+
+        С limited=True на сервере одновременно не больше concurrency отправок,
+        и при занятых серверах поток ждет освобождения места.
+        """
+        with self._lock:
+            while True:
+                available = [relay for relay in self.relays
+                             if relay not in exclude and relay.breaker.is_available()]
+                if not available:
+                    return None
+                if limited:
+                    available = [relay for relay in available
+                                 if relay.outstanding < (relay.concurrency or settings.DISPATCH_HOST_CONCURRENCY)]
+                if available:
+                    relay = self._choose(available)
+                    relay.outstanding += 1
+                    return relay
+                self._lock.wait()
+
+    def release(self, relay):
+        with self._lock:
+            relay.outstanding -= 1
+            self._lock.notify_all()
+
+    def count(self, relay, counter):
+        """Увеличивает счетчик сервера: sent - отправлено, failed - ошибок, failovers - переключений на другой сервер"""
+        with self._lock:
+            relay.counters[counter] += 1
+
+    def publish(self):
+        """Добавляет накопленные счетчики серверов к общим счетчикам в кеше, откуда их читает smtpstatus"""
+        with self._lock:
+            counters = [(relay, relay.counters) for relay in self.relays]
+            for relay in self.relays:
+                relay.counters = dict.fromkeys(COUNTERS, 0)
+        for relay, values in counters:
+            for counter, value in values.items():
+                if value:
+                    key = get_counter_key(relay.name, counter)
+                    cache.add(key, 0, None)
+                    cache.incr(key, value)
+
+
+def get_counter_key(name, counter):
+    return f'smtp_relay:{name}:{counter}'
+
+
+def get_relays():
+    """Серверы из EMAIL_RELAYS, без него - единственный сервер из настроек EMAIL_*"""
+    if settings.EMAIL_RELAYS:
+        return [Relay(**relay) for relay in settings.EMAIL_RELAYS]
+    return [Relay(settings.EMAIL_HOST, settings.EMAIL_PORT, settings.EMAIL_HOST_USER, settings.EMAIL_HOST_PASSWORD,
+                  settings.EMAIL_USE_TLS, settings.EMAIL_USE_SSL)]
+
+
+_relay_pool = None
+_relay_pool_lock = threading.Lock()
+
+
+def get_relay_pool():
+    """Общий для процесса набор серверов из настроек"""
+    global _relay_pool
+    with _relay_pool_lock:
+        if _relay_pool is None:
+            _relay_pool = RelayPool(get_relays())
+        return _relay_pool
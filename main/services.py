@@ -1,72 +1,171 @@
-from datetime import datetime, timedelta
-from smtplib import SMTPException
+from datetime import datetime
+from smtplib import SMTPException, SMTPRecipientsRefused
 from django.conf import settings
-from django.core.mail import send_mail
 from django.utils import timezone
 from django.core.cache import cache
+from django.db.models import Case, DateTimeField, Value, When
 
-from main.models import Mailing, Log, Client
+from main.breaker import CircuitOpenError
+from main.coalescing import coalescer
+from main.executor import DispatchExecutor
+from main.leases import LeaseKeeper, claim_mailings, get_worker_id, release_mailings
+from main.log_sink import log_sink
+from main.models import Mailing, Client, Checkpoint
+from main.outbox import enqueue_mailing
+from main.payload import get_envelope_size, get_message_template
+from main.ratelimit import rate_limiter
+from main.recurrence import get_next_occurrence, is_missed
+from main.relays import get_relay_pool
+from main.spreading import get_spread_window
+from main.suppression import is_hard_bounce, suppression_list
+from main.transport import SMTPSession
 
 
-def change_status(mailing, time):
-    if mailing.status == 'Создана':
-        mailing.status = 'Запущена'
-        print('Запущена')
-    elif mailing.status == 'Запущена' and mailing.end_time <= time:
-        mailing.status = 'Завершена'
-        print('Завершена')
-    mailing.save()
+def change_statuses(time):
+    """Функция смены статусов рассылок, по одному запросу UPDATE на каждый переход.
 
+    Условие перехода проверяется в WHERE, поэтому записываются только рассылки,
+    статус которых действительно меняется, и только поле status.
+    """
+    active = Mailing.objects.filter(is_active=True)
+    started = active.filter(status=Mailing.CREATED, start_time__lte=time).update(status=Mailing.STARTED)
+    completed = active.filter(status=Mailing.STARTED, end_time__lte=time).update(status=Mailing.COMPLETED)
+    if started or completed:
+        print(f'рассылок запущено: {started}, завершено: {completed}')
 
-def change_start_datetime_mailing(mailing, time):
-    if mailing.start_time < time:
-        if mailing.periodicity == 'Ежедневно':
-            mailing.start_time += timedelta(days=1)
-        elif mailing.periodicity == 'Еженедельно':
-            mailing.start_time += timedelta(days=7)
-        elif mailing.periodicity == 'Ежемесячно':
-            mailing.start_time += timedelta(days=30)
-        mailing.save()
+
+def change_start_datetime_mailings(mailings, time):
+    """Функция переноса следующей отправки рассылок на первое плановое время после time.
+
+    Сколько бы отправок ни было пропущено, перенос выполняется за один шаг,
+    новое время всех рассылок записывается одним запросом UPDATE.
+    """
+    if not mailings:
+        return
+    for mailing in mailings:
+        mailing.next_time = get_next_occurrence(mailing.start_time, mailing.periodicity, time)
+    Mailing.objects.filter(pk__in=[mailing.pk for mailing in mailings]).update(
+        next_time=Case(*(When(pk=mailing.pk, then=Value(mailing.next_time)) for mailing in mailings),
+                       output_field=DateTimeField())
+    )
+
+
+def get_due_mailings(time):
+    """Функция получения рассылок, время отправки которых наступило (использует индекс mailing_due_idx).
+
+    Рассылки без письма (письмо удалено) не отправляются.
+    """
+    return Mailing.objects.filter(
+        is_active=True,
+        status__in=(Mailing.CREATED, Mailing.STARTED),
+        next_time__lte=time,
+        end_time__gte=time,
+        letter__isnull=False,
+    ).select_related('letter')
+
+
+def send_batch(mailing, clients):
+    """Функция отправки письма рассылки группе клиентов через одно SMTP-соединение.
+
+    Письмо собирается один раз на запуск рассылки, для клиента меняются только заголовки получателя.
+    Письмо без подстановок уходит одной SMTP-транзакцией сразу EMAIL_ENVELOPE_SIZE клиентам,
+    отказы сервера по отдельным адресам записываются в лог каждого клиента,
+    постоянные отказы учитываются в стоп-листе.
+    """
+    sent = 0
+    template = get_message_template(mailing)
+    size = get_envelope_size(mailing)
+    with SMTPSession() as session:
+        for processed in range(0, len(clients), size):
+            envelope = clients[processed:processed + size]
+            message = template.render_envelope(envelope)
+            try:
+                rate_limiter.acquire(owner_id=mailing.owner_id, tokens=len(envelope))
+                session.send(message)
+                refused = message.refused
+            except CircuitOpenError as error:
+                # сервер недоступен: остальные клиенты пачки откладываются без записи в лог
+                error.processed, error.sent = processed, sent
+                raise
+            except SMTPRecipientsRefused as error:
+                refused = error.recipients
+            except (SMTPException, OSError) as error:
+                refused = dict.fromkeys(message.recipients(), error)
+            bounces = []
+            for client, address in zip(envelope, message.recipients()):
+                if address in refused:
+                    log_sink.add(mailing, 'Безуспешно', refused[address])
+                    coalescer.record(mailing, client, 'Безуспешно', refused[address])
+                    print('Ошибка')
+                    if is_hard_bounce(refused[address]):
+                        bounces.append((client['email'], refused[address]))
+                else:
+                    log_sink.add(mailing, 'Успешно', 1)
+                    coalescer.record(mailing, client, 'Успешно', 1)
+                    sent += 1
+            if bounces:
+                suppression_list.record_bounces(bounces)
+    return sent
+
+
+def send_mailings(mailings):
+    """Функция отправки рассылок выбранным в настройках способом: пулом потоков, через asyncio
+    или постановкой в исходящую очередь, которую разбирают отправители runsender"""
+    try:
+        if settings.DISPATCH_MODE == 'outbox':
+            return {mailing: enqueue_mailing(mailing) for mailing in mailings}
+        if settings.DISPATCH_MODE == 'async':
+            from main.async_dispatch import dispatch_async
+            results = dispatch_async(mailings)
+        else:
+            results = DispatchExecutor().dispatch(mailings, send_batch)
+        if coalescer.saved:
+            print(f'повторных отправок одинаковых писем сэкономлено: {coalescer.saved}')
+        return coalescer.add_results(results)
+    finally:
+        print(f'логов сохранено: {log_sink.flush()}')
 
 
 def my_job():
     print('my_job запущен')
     now = datetime.now()
     timenow = timezone.make_aware(now, timezone.get_current_timezone())
-    mailings = Mailing.objects.filter(is_active=True)
-    if mailings:
-        for mailing in mailings:
-            change_status(mailing, timenow)
-            if mailing.start_time <= timenow <= mailing.end_time:
-                for client in mailing.clients.all():
-                    try:
-                        response = send_mail(
-                            subject=mailing.letter.title,
-                            message=mailing.letter.text,
-                            from_email=settings.EMAIL_HOST_USER,
-                            recipient_list=[client.email],
-                            fail_silently=False
-                        )
-                        mailing_log = Log.objects.create(
-                            last_attempt_time=mailing.start_time,
-                            attempt_status='Успешно',
-                            server_response=response,
-                            mailing=mailing
-                        )
-                        mailing_log.save()
-                        change_start_datetime_mailing(mailing, timenow)
-                        print('лог сохранен')
-                    except SMTPException as error:
-                        mailing_log = Log.objects.create(
-                            last_attempt_time=mailing.start_time,
-                            attempt_status='Безуспешно',
-                            server_response=error,
-                            mailing=mailing
-                        )
-                        mailing_log.save()
-                        print('Ошибка')
-    else:
-        print('нет активных рассылок')
+    change_statuses(timenow)
+    relays = get_relay_pool()
+    if settings.DISPATCH_MODE != 'outbox' and not relays.is_available():
+        # рассылки не переводятся в ошибку, а ждут восстановления SMTP-серверов
+        print(f'SMTP-серверы недоступны, рассылки отложены до {relays.get_open_error().retry_at}')
+        return
+    suppression_list.load()
+    # рассылки захватываются частями, чтобы несколько процессов планировщика делили их между собой
+    worker_id = get_worker_id()
+    processed = []
+    while claimed := claim_mailings(get_due_mailings(timenow).exclude(pk__in=processed), worker_id):
+        processed.extend(mailing.pk for mailing in claimed)
+        due_mailings, missed = [], []
+        for mailing in claimed:
+            # запуск, растянутый на окно распределения, не считается пропущенным до конца окна
+            grace = max(settings.MAILING_CATCHUP_GRACE, get_spread_window(mailing))
+            if is_missed(mailing.start_time, mailing.periodicity, timenow, grace=grace):
+                missed.append(mailing)
+                print('Пропущена')
+            else:
+                due_mailings.append(mailing)
+        change_start_datetime_mailings(missed, timenow)
+        try:
+            with LeaseKeeper(due_mailings, worker_id):
+                results = send_mailings(due_mailings)
+            finished = [mailing for mailing in due_mailings if getattr(mailing, 'run_finished', True)]
+            change_start_datetime_mailings([mailing for mailing in finished if results.get(mailing)], timenow)
+            # запуск завершен штатно, контрольные точки нужны только после падения
+            # и для продолжения запусков, растянутых на окно распределения
+            Checkpoint.objects.filter(mailing_id__in=[mailing.pk for mailing in finished + missed]).delete()
+        finally:
+            release_mailings(claimed, worker_id)
+    if not processed:
+        print('нет рассылок для отправки')
+    if suppression_list.skipped:
+        print(f'пропущено адресов из стоп-листа: {suppression_list.skipped}')
 
 
 def get_cache_mailing_count():
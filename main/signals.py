@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from main.models import Mailing
+from main.next_fire import notify_mailing_changed
+
+
+@receiver([post_save, post_delete], sender=Mailing)
+def mailing_changed(sender, instance, **kwargs):
+    """Уведомляет планировщик о создании, изменении, включении/отключении и удалении рассылки"""
+    notify_mailing_changed(instance.pk)
@@ -0,0 +1,118 @@
+import asyncio
+import threading
+
+
+class StubSMTPServer:
+    """Локальный SMTP-сервер на asyncio для замеров и проверки рассылки.
+
+    Письма никуда не отправляются, сервер только считает соединения, сообщения (транзакции DATA)
+    и принятых получателей. connect_delay имитирует стоимость установки соединения (TLS, AUTH),
+    message_delay - время ответа сервера на одно письмо.
+    refuse - адреса (или функция от адреса), которым сервер отвечает на RCPT TO отказом 550.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, connect_delay=0.0, message_delay=0.0, refuse=()):
+        self.host = host
+        self.port = port
+        self.connect_delay = connect_delay
+        self.message_delay = message_delay
+        self.refuse = refuse if callable(refuse) else set(refuse).__contains__
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    async def _reply(self, writer, line):
+        writer.write(f'{line}\r\n'.encode())
+        await writer.drain()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        if self.connect_delay:
+            await asyncio.sleep(self.connect_delay)
+        await self._reply(writer, '220 stub ESMTP')
+        accepted = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                verb = command.split(' ', 1)[0].upper()
+                if verb == 'EHLO':
+                    await self._reply(writer, '250-stub')
+                    await self._reply(writer, '250 8BITMIME')
+                elif verb in ('MAIL', 'RSET'):
+                    accepted = 0
+                    await self._reply(writer, '250 OK')
+                elif verb == 'RCPT':
+                    address = command.partition('<')[2].partition('>')[0]
+                    if self.refuse(address):
+                        await self._reply(writer, '550 No such user')
+                    else:
+                        accepted += 1
+                        await self._reply(writer, '250 OK')
+                elif verb == 'DATA' and not accepted:
+                    await self._reply(writer, '554 No valid recipients')
+                elif verb == 'DATA':
+                    await self._reply(writer, '354 End data with <CR><LF>.<CR><LF>')
+                    while (await reader.readline()) not in (b'.\r\n', b''):
+                        pass
+                    if self.message_delay:
+                        await asyncio.sleep(self.message_delay)
+                    self.messages += 1
+                    self.recipients += accepted
+                    accepted = 0
+                    await self._reply(writer, '250 OK queued')
+                elif verb == 'QUIT':
+                    await self._reply(writer, '221 Bye')
+                    break
+                else:
+                    await self._reply(writer, '250 OK')
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self._serve())
+        except asyncio.CancelledError:
+            pending = asyncio.all_tasks(self._loop)
+            self._loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            self._loop.close()
+
+    def _shutdown(self):
+        for task in asyncio.all_tasks(self._loop):
+            task.cancel()
+
+    def start(self):
+        """Запускает сервер в фоновом потоке и ждет, пока он начнет принимать соединения"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        """Останавливает сервер"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._shutdown)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,34 @@
+import math
+import zlib
+
+from django.conf import settings
+
+EVEN = 'even'
+HASH = 'hash'
+
+
+def get_spread_window(mailing):
+    """Окно распределения отправки рассылки в секундах (0 - все письма сразу)"""
+    minutes = settings.DISPATCH_SPREAD_WINDOW if mailing.spread_window is None else mailing.spread_window
+    return minutes * 60
+
+
+def get_allowed_count(total, run_time, now, window):
+    """Сколько из total клиентов должны получить письмо к моменту now при равномерном распределении"""
+    if not window:
+        return total
+    elapsed = (now - run_time).total_seconds()
+    return min(total, math.ceil(total * max(elapsed, 0) / window))
+
+
+def get_offset(index, total, client_id, window, mode=None):
+    """Смещение отправки клиенту от начала запуска рассылки в секундах.
+
+    even - клиенты равномерно распределяются по окну в порядке pk,
+    hash - смещение определяется хешем клиента и не меняется от запуска к запуску.
+    """
+    if not window:
+        return 0
+    if (mode or settings.DISPATCH_SPREAD_MODE) == HASH:
+        return zlib.crc32(str(client_id).encode()) % (window * 1000) / 1000
+    return index * window / total
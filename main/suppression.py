@@ -0,0 +1,142 @@
+import hashlib
+import math
+import threading
+from datetime import timedelta
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from main.models import Bounce, Suppression
+
+
+def normalize_email(email):
+    """Адрес для сравнения со стоп-листом"""
+    return email.strip().lower()
+
+
+def is_hard_bounce(response):
+    """Постоянный отказ сервера по адресу получателя (код 5xx), а не временная или сетевая ошибка"""
+    return isinstance(response, tuple) and 500 <= response[0] < 600
+
+
+class BloomFilter:
+    """Фильтр Блума: множество адресов в виде битового массива, без хранения самих адресов.
+
+    Отсутствующий в фильтре адрес точно не добавлялся, присутствующий - добавлялся
+    с вероятностью 1 - error_rate, поэтому попадания подтверждаются точной проверкой.
+    Размер массива и число хешей подбираются по ожидаемому количеству адресов capacity.
+    """
+
+    def __init__(self, capacity, error_rate=None):
+        error_rate = error_rate or settings.SUPPRESSION_BLOOM_ERROR_RATE
+        capacity = self.capacity = max(capacity, 1)
+        self.size = max(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2), 64)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # двойное хеширование: все позиции из одного хеша blake2b
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class SuppressionList:
+    """Стоп-лист в памяти процесса.
+
+    Адреса из модели Suppression загружаются в фильтр Блума один раз за запуск планировщика:
+    в фильтр дописываются только адреса, добавленные после прошлой загрузки, а заново он строится,
+    когда адресов становится больше, чем рассчитан фильтр. Удаленные из стоп-листа адреса остаются
+    в фильтре до его перестроения, их отсеивает проверка попаданий по базе.
+    Клиенты пачки проверяются по фильтру, и только попадания подтверждаются одним запросом к базе,
+    поэтому адреса из стоп-листа исключаются до отправки, не занимая ни SMTP-транзакций, ни записей лога.
+    Адрес попадает в стоп-лист после SUPPRESSION_BOUNCE_LIMIT постоянных отказов сервера.
+    """
+
+    def __init__(self):
+        self.filter = BloomFilter(0)
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def load(self):
+        """Дописывает в фильтр новые адреса стоп-листа, возвращает количество загруженных адресов"""
+        count = Suppression.objects.count()
+        bloom, last_id = self.filter, self.last_id
+        if count > bloom.capacity:
+            # запас, чтобы фильтр не перестраивался на каждом запуске
+            bloom, last_id = BloomFilter(count * 2 + settings.DISPATCH_BATCH_SIZE), 0
+        loaded = 0
+        added = Suppression.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'email')
+        for pk, email in added.iterator():
+            bloom.add(email)
+            last_id, loaded = pk, loaded + 1
+        with self.lock:
+            self.filter, self.last_id, self.skipped = bloom, last_id, 0
+        return loaded
+
+    def exclude(self, rows, key=itemgetter('email')):
+        """Строки клиентов без адресов из стоп-листа, key - адрес клиента из строки"""
+        hits = {email for email in map(normalize_email, map(key, rows)) if email in self.filter}
+        if not hits:
+            return rows
+        suppressed = set(Suppression.objects.filter(email__in=hits).values_list('email', flat=True))
+        if not suppressed:
+            return rows
+        kept = [row for row in rows if normalize_email(key(row)) not in suppressed]
+        with self.lock:
+            self.skipped += len(rows) - len(kept)
+        return kept
+
+    def record_bounces(self, bounces):
+        """Учитывает постоянные отказы сервера, bounces - пары (адрес, ответ сервера).
+
+        Отказы считаются в модели Bounce за SUPPRESSION_BOUNCE_WINDOW дней с первого отказа периода,
+        адреса, набравшие SUPPRESSION_BOUNCE_LIMIT отказов, добавляются в стоп-лист. Строки счетчиков
+        блокируются на время обновления, поэтому отказы из разных процессов и потоков не теряются.
+        """
+        responses = {}
+        for email, response in bounces:
+            responses.setdefault(normalize_email(email), []).append(str(response))
+        if not responses:
+            return 0
+        now = timezone.now()
+        window_start = now - timedelta(days=settings.SUPPRESSION_BOUNCE_WINDOW)
+        suppressed = {}
+        with transaction.atomic():
+            Bounce.objects.bulk_create(
+                (Bounce(email=email, window_start=now) for email in responses), ignore_conflicts=True
+            )
+            counters = list(Bounce.objects.select_for_update().filter(email__in=responses).order_by('email'))
+            for counter in counters:
+                if counter.window_start < window_start:
+                    # период подсчета истек, отказы считаются заново
+                    counter.count, counter.window_start = 0, now
+                counter.count += len(responses[counter.email])
+                counter.server_response = responses[counter.email][-1]
+                if counter.count >= settings.SUPPRESSION_BOUNCE_LIMIT:
+                    suppressed[counter.email] = Suppression(
+                        email=counter.email, reason=Suppression.BOUNCE, server_response=counter.server_response
+                    )
+            Bounce.objects.bulk_update(counters, ['count', 'window_start', 'server_response'])
+            if suppressed:
+                Suppression.objects.bulk_create(suppressed.values(), ignore_conflicts=True)
+        if not suppressed:
+            return 0
+        with self.lock:
+            for email in suppressed:
+                self.filter.add(email)
+        print(f'адресов добавлено в стоп-лист: {len(suppressed)}')
+        return len(suppressed)
+
+
+suppression_list = SuppressionList()
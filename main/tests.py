@@ -1,3 +1,327 @@
-from django.test import TestCase
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import skipUnless
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from main import relays
+from main.coalescing import coalescer
+from main.executor import plan_batches
+from main.leader import LeaderElection
+from main.leases import claim_mailings, get_worker_id
+from main.log_sink import log_sink
+from main.models import Bounce, Checkpoint, Client, Delivery, Log, Mailing, Message, Suppression
+from main.next_fire import get_fire_time
+from main.outbox import claim_deliveries, drain, enqueue_mailing, get_backoff
+from main.recurrence import COALESCE, SKIP, get_next_occurrence, is_missed
+from main.services import get_due_mailings
+from main.smtp_stub import StubSMTPServer
+from main.suppression import SuppressionList
+from users.models import User
+
+
+class DispatchPlanQueriesTest(TestCase):
+    """Количество запросов на захват рассылок и построение плана отправки не зависит от числа клиентов"""
+
+    # захват рассылок (SAVEPOINT, SELECT FOR UPDATE, UPDATE, RELEASE SAVEPOINT), контрольные точки (SELECT
+    # и bulk_create), количество клиентов, объединение одинаковых писем и веса владельцев
+    PLAN_QUERIES = 9
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email='owner@example.com')
+        cls.letter = Message.objects.create(title='Тема', text='Текст', owner=cls.owner)
+        cls.clients = Client.objects.bulk_create(
+            Client(first_name=f'Имя{i}', last_name=f'Фамилия{i}', email=f'client{i}@example.com', owner=cls.owner)
+            for i in range(200)
+        )
+
+    def create_mailings(self, count, audience):
+        now = timezone.now()
+        mailings = Mailing.objects.bulk_create(
+            Mailing(start_time=now - timedelta(minutes=1), next_time=now - timedelta(minutes=1),
+                    end_time=now + timedelta(days=1), status=Mailing.STARTED, letter=self.letter, owner=self.owner)
+            for _ in range(count)
+        )
+        Mailing.clients.through.objects.bulk_create(
+            Mailing.clients.through(mailing_id=mailing.pk, client_id=client.pk)
+            for mailing in mailings for client in self.clients[:audience]
+        )
+        return now
+
+    def test_plan_queries(self):
+        for audience in (10, 200):
+            with self.subTest(audience=audience):
+                Mailing.objects.all().delete()
+                now = self.create_mailings(3, audience)
+                with self.assertNumQueries(self.PLAN_QUERIES):
+                    mailings = claim_mailings(get_due_mailings(now), get_worker_id())
+                    batches, _ = plan_batches(mailings, batch_size=50, now=now)
+                self.assertEqual(len(mailings), 3)
+                # клиенты выбираются по одному запросу на пачку, одинаковые письма уходят один раз
+                self.assertEqual(sum(len(batch.clients) for batch in batches), audience)
+
+
+class DueMailingsQueryPlanTest(TestCase):
+    """Рассылки к отправке выбираются по индексу mailing_due_idx, без полного просмотра таблицы"""
+
+    def test_due_mailings_use_index(self):
+        now = timezone.now()
+        letter = Message.objects.create(title='Тема', text='Текст')
+        Mailing.objects.bulk_create(
+            # как и в рабочей базе, большинство рассылок уже завершено
+            Mailing(start_time=now - timedelta(days=1), next_time=now + timedelta(minutes=i),
+                    end_time=now + timedelta(days=1), status=Mailing.STARTED if i < 5 else Mailing.COMPLETED,
+                    letter=letter)
+            for i in range(200)
+        )
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # на маленькой таблице PostgreSQL предпочел бы полный просмотр, проверяем, что индекс применим
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'ANALYZE {Mailing._meta.db_table}')
+        self.assertIn('mailing_due_idx', get_due_mailings(now).explain())
+
+
+@override_settings(SUPPRESSION_BOUNCE_LIMIT=3, SUPPRESSION_BOUNCE_WINDOW=30)
+class BounceCounterTest(TestCase):
+    """Отказы по адресу считаются в базе, общей для всех процессов планировщика"""
+
+    def test_bounces_counted_across_processes(self):
+        # у каждого процесса свой стоп-лист в памяти
+        first, second = SuppressionList(), SuppressionList()
+        bounce = [(' User@Example.com', (550, b'No such user'))]
+        self.assertEqual(first.record_bounces(bounce), 0)
+        self.assertEqual(second.record_bounces(bounce), 0)
+        self.assertEqual(first.record_bounces(bounce), 1)
+        self.assertTrue(Suppression.objects.filter(email='user@example.com', reason=Suppression.BOUNCE).exists())
+        self.assertIn('user@example.com', first.filter)
+
+    def test_expired_window_resets_counter(self):
+        Bounce.objects.create(email='user@example.com', count=2, window_start=timezone.now() - timedelta(days=31))
+        self.assertEqual(SuppressionList().record_bounces([('user@example.com', (550, b'No such user'))]), 0)
+        self.assertEqual(Bounce.objects.get(email='user@example.com').count, 1)
+
+
+# тестовый раннер подменяет почтовый бэкенд, письма отправляются на локальный StubSMTPServer
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST_USER='from@example.com',
+                   OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_BASE=60, OUTBOX_RETRY_MAX=3600)
+class OutboxTest(TestCase):
+    """Исходящая очередь: постановка, захват, отправка и повторные попытки доставок"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email='owner@example.com')
+        cls.letter = Message.objects.create(title='Тема', text='Текст', owner=cls.owner)
+        cls.clients = Client.objects.bulk_create(
+            Client(first_name=f'Имя{i}', last_name=f'Фамилия{i}', email=f'client{i}@example.com', owner=cls.owner)
+            for i in range(3)
+        )
+
+    def setUp(self):
+        self.refused = set()
+        self.server = StubSMTPServer(refuse=lambda address: address in self.refused).start()
+        self.addCleanup(self.server.stop)
+        relay = {'host': self.server.host, 'port': self.server.port, 'name': f'outbox-test-{self.server.port}'}
+        settings_override = override_settings(EMAIL_RELAYS=[relay])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # пул серверов собирается заново из настроек теста
+        relays._relay_pool = None
+        self.addCleanup(setattr, relays, '_relay_pool', None)
+
+    def create_mailing(self):
+        now = timezone.now()
+        mailing = Mailing.objects.create(start_time=now, next_time=now, end_time=now + timedelta(days=1),
+                                         status=Mailing.STARTED, letter=self.letter, owner=self.owner)
+        mailing.clients.set(self.clients)
+        enqueue_mailing(mailing, run_time=now)
+        return mailing
+
+    def states(self, mailing):
+        return sorted(Delivery.objects.filter(mailing=mailing).values_list('state', 'attempts'))
+
+    def test_delivery_sent(self):
+        mailing = self.create_mailing()
+        self.assertEqual(Delivery.objects.filter(mailing=mailing, state=Delivery.PENDING).count(), 3)
+        self.assertEqual(drain(), 3)
+        self.assertEqual(self.states(mailing), [(Delivery.SENT, 1)] * 3)
+        self.assertEqual(self.server.recipients, 3)
+        self.assertEqual(drain(), 0)
+
+    def test_retry_until_max_attempts(self):
+        self.refused.add('client0@example.com')
+        mailing = self.create_mailing()
+        drain()
+        delivery = Delivery.objects.get(mailing=mailing, client=self.clients[0])
+        self.assertEqual((delivery.state, delivery.attempts), (Delivery.PENDING, 1))
+        self.assertGreater(delivery.next_attempt_time, timezone.now() + timedelta(seconds=40))
+        self.assertIn('550', delivery.last_error)
+        # время повторной попытки наступило
+        Delivery.objects.filter(pk=delivery.pk).update(next_attempt_time=timezone.now())
+        self.assertEqual(drain(), 1)
+        self.assertEqual(self.states(mailing), [(Delivery.FAILED, 2), (Delivery.SENT, 1), (Delivery.SENT, 1)])
+        Delivery.objects.filter(pk=delivery.pk).update(next_attempt_time=timezone.now())
+        self.assertEqual(drain(), 0)
+
+    def test_backoff_grows_up_to_limit(self):
+        self.assertTrue(timedelta(seconds=48) <= get_backoff(1) <= timedelta(seconds=60))
+        self.assertTrue(timedelta(seconds=192) <= get_backoff(3) <= timedelta(seconds=240))
+        self.assertLessEqual(get_backoff(20), timedelta(seconds=3600))
+
+    def test_exhausted_delivery_not_claimed(self):
+        # отправитель упал после второго захвата, не сохранив результат
+        mailing = self.create_mailing()
+        Delivery.objects.filter(mailing=mailing).update(attempts=2)
+        self.assertEqual(claim_deliveries(), [])
+        self.assertEqual(self.states(mailing), [(Delivery.FAILED, 2)] * 3)
+
+    def test_deleted_letter_and_blocked_mailing_cancelled(self):
+        deleted, blocked = self.create_mailing(), self.create_mailing()
+        deleted.letter = Message.objects.create(title='Удаленное', text='Текст', owner=self.owner)
+        deleted.save()
+        deleted.letter.delete()
+        Mailing.objects.filter(pk=blocked.pk).update(is_active=False)
+        self.assertEqual(drain(), 0)
+        self.assertEqual(self.states(deleted), [(Delivery.CANCELLED, 0)] * 3)
+        self.assertEqual(self.states(blocked), [(Delivery.CANCELLED, 0)] * 3)
+        self.assertEqual(self.server.recipients, 0)
+
+
+class FireTimeTest(SimpleTestCase):
+    """Ближайшее событие рассылки для очереди планировщика в режиме event"""
+
+    def test_fire_time(self):
+        now = timezone.now()
+        later = now + timedelta(days=1)
+        self.assertEqual(get_fire_time(now, later), now)
+        self.assertEqual(get_fire_time(later, now), now)
+        # без следующей отправки рассылка все равно завершается в end_time
+        self.assertEqual(get_fire_time(None, later), later)
+        self.assertEqual(get_fire_time(now, None), now)
+        self.assertIsNone(get_fire_time(None, None))
+
+
+class CoalescingTest(TestCase):
+    """Одинаковое письмо нескольких рассылок уходит клиенту один раз, рассылкой с меньшим pk"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create(email='owner@example.com')
+        cls.letter = Message.objects.create(title='Тема', text='Текст', owner=cls.owner)
+        cls.clients = Client.objects.bulk_create(
+            Client(first_name=f'Имя{i}', last_name=f'Фамилия{i}', email=f'client{i}@example.com', owner=cls.owner)
+            for i in range(4)
+        )
+
+    def dispatch(self, primary_sends):
+        """Имитирует отправку: каждый клиент пачки получает письмо, пачки основной рассылки
+        без primary_sends откладываются предохранителем, не дойдя ни до одного клиента"""
+        now = timezone.now()
+        mailings = Mailing.objects.bulk_create(
+            Mailing(start_time=now - timedelta(minutes=1), next_time=now - timedelta(minutes=1),
+                    end_time=now + timedelta(days=1), status=Mailing.STARTED, letter=self.letter, owner=self.owner)
+            for _ in range(2)
+        )
+        for mailing in mailings:
+            mailing.clients.set(self.clients)
+        claimed = sorted(claim_mailings(get_due_mailings(now), get_worker_id()), key=lambda mailing: mailing.pk)
+        batches, _ = plan_batches(claimed, batch_size=10, now=now)
+        for batch in batches:
+            if batch.mailing == claimed[0] and not primary_sends:
+                batch.defer(0, 0)
+                continue
+            for client in batch.clients:
+                log_sink.append(batch.mailing, 'Успешно', 1)
+                coalescer.record(batch.mailing, client, 'Успешно', 1)
+                batch.sent += 1
+            batch.done()
+        coalescer.finish()
+        log_sink.flush()
+        return claimed
+
+    def test_follower_covered_by_primary(self):
+        primary, follower = self.dispatch(primary_sends=True)
+        self.assertEqual(Log.objects.filter(mailing_id=primary.pk).count(), 4)
+        self.assertEqual(Log.objects.filter(mailing_id=follower.pk).count(), 4)
+        self.assertTrue(follower.run_finished)
+        self.assertEqual(Checkpoint.objects.get(mailing_id=follower.pk).last_client_id, self.clients[-1].pk)
+
+    def test_follower_not_skipped_when_primary_deferred(self):
+        primary, follower = self.dispatch(primary_sends=False)
+        # основная рассылка не дошла до клиентов: остальные рассылки не считают их обработанными
+        self.assertFalse(Log.objects.filter(mailing_id=follower.pk).exists())
+        self.assertFalse(follower.run_finished)
+        self.assertEqual(Checkpoint.objects.get(mailing_id=follower.pk).last_client_id, 0)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'выбор лидера работает только с PostgreSQL')
+class LeaderElectionTest(TestCase):
+    """Лидером планировщика одновременно может быть только один процесс"""
+
+    # своя блокировка, чтобы не мешать запущенному планировщику
+    KEY = zlib.crc32(b'mailing_manager.tests.leader')
+
+    def test_single_leader(self):
+        first = LeaderElection(self.KEY, heartbeat=1, timeout=5)
+        second = LeaderElection(self.KEY, heartbeat=1, timeout=5)
+        self.addCleanup(first.release)
+        self.addCleanup(second.release)
+        self.assertTrue(first.try_acquire())
+        self.assertFalse(second.try_acquire())
+        self.assertTrue(first.is_alive())
+        first.release()
+        self.assertFalse(first.is_leader)
+        self.assertTrue(second.try_acquire())
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=dt_timezone.utc)
+
+
+class RecurrenceTest(SimpleTestCase):
+    """Плановое время отправки повторяющихся рассылок"""
+
+    def test_monthly_keeps_day_of_month(self):
+        anchor = utc(2023, 1, 31, 10)
+        # в коротком месяце - последний день, дальше снова 31 число
+        self.assertEqual(get_next_occurrence(anchor, Mailing.MONTHLY, anchor, dt_timezone.utc), utc(2023, 2, 28, 10))
+        self.assertEqual(get_next_occurrence(anchor, Mailing.MONTHLY, utc(2023, 2, 28, 10), dt_timezone.utc),
+                         utc(2023, 3, 31, 10))
+        self.assertEqual(get_next_occurrence(utc(2024, 1, 31, 10), Mailing.MONTHLY, utc(2024, 2, 1), dt_timezone.utc),
+                         utc(2024, 2, 29, 10))
+
+    def test_daily_keeps_local_time_across_dst(self):
+        berlin = ZoneInfo('Europe/Berlin')
+        anchor = datetime(2024, 3, 30, 9, tzinfo=berlin)
+        # 31 марта часы переводятся на летнее время: 09:00 по Берлину - это 07:00 UTC вместо 08:00
+        self.assertEqual(get_next_occurrence(anchor, Mailing.DAILY, anchor, berlin), utc(2024, 3, 31, 7))
+        anchor = datetime(2024, 10, 26, 9, tzinfo=berlin)
+        self.assertEqual(get_next_occurrence(anchor, Mailing.DAILY, anchor, berlin), utc(2024, 10, 27, 8))
+
+    def test_next_occurrence_strictly_after(self):
+        anchor = utc(2024, 1, 1, 9)
+        self.assertEqual(get_next_occurrence(anchor, Mailing.WEEKLY, utc(2024, 1, 8, 9), dt_timezone.utc),
+                         utc(2024, 1, 15, 9))
+        # сколько бы отправок ни было пропущено, перенос в один шаг
+        self.assertEqual(get_next_occurrence(anchor, Mailing.DAILY, utc(2024, 3, 1, 12), dt_timezone.utc),
+                         utc(2024, 3, 2, 9))
+        self.assertEqual(get_next_occurrence(anchor, Mailing.DAILY, utc(2023, 12, 1), dt_timezone.utc), anchor)
+        # разовая рассылка
+        self.assertEqual(get_next_occurrence(anchor, 'once', utc(2023, 12, 1)), anchor)
+        self.assertIsNone(get_next_occurrence(anchor, 'once', anchor))
+
+    @override_settings(TIME_ZONE='UTC')
+    def test_missed_by_policy(self):
+        anchor = utc(2024, 1, 1, 9)
+        on_time, late = utc(2024, 1, 5, 9, 59), utc(2024, 1, 5, 10, 1)
+        self.assertFalse(is_missed(anchor, Mailing.DAILY, on_time, policy=SKIP, grace=3600))
+        self.assertTrue(is_missed(anchor, Mailing.DAILY, late, policy=SKIP, grace=3600))
+        # coalesce: пропущенные отправки выполняются сразу одной
+        self.assertFalse(is_missed(anchor, Mailing.DAILY, late, policy=COALESCE, grace=3600))
+        # до первой отправки пропускать нечего
+        self.assertFalse(is_missed(anchor, Mailing.DAILY, utc(2023, 12, 31), policy=SKIP, grace=0))
+        self.assertTrue(is_missed(anchor, 'once', late, policy=SKIP, grace=3600))
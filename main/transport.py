@@ -0,0 +1,114 @@
+from contextlib import suppress
+from smtplib import SMTPServerDisconnected
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+from main.breaker import CircuitOpenError, is_transport_error
+from main.ratelimit import rate_limiter
+from main.relays import Relay, RelayPool, get_relay_pool
+
+
+class SMTPSession:
+    """Постоянное SMTP-соединение для отправки писем одной рассылки.
+
+    Соединение открывается один раз и переиспользуется для всех писем,
+    после max_messages писем оно пересоздается, при обрыве - восстанавливается.
+    Сервер для каждого нового соединения выбирается из пула серверов EMAIL_RELAYS (с явными параметрами
+    бэкенда - единственный сервер). Если сервер недоступен, письмо отправляется через
+    следующий; если предохранители всех серверов открыты, send выбрасывает CircuitOpenError.
+    """
+
+    def __init__(self, max_messages=None, relays=None, **backend_kwargs):
+        self.max_messages = max_messages or settings.EMAIL_CONNECTION_MAX_MESSAGES
+        if relays is None:
+            relays = RelayPool([Relay.from_backend_kwargs(backend_kwargs)]) if backend_kwargs else get_relay_pool()
+        self.relays = relays
+        self.relay = None
+        self.connection = None
+        self.sent_on_connection = 0
+
+    def open(self):
+        """Открывает соединение с выбранным сервером, если оно еще не открыто"""
+        if self.connection is None:
+            connection = get_connection(fail_silently=False, **self.relay.get_backend_kwargs())
+            connection.open()
+            self.connection = connection
+            self.sent_on_connection = 0
+
+    def close(self):
+        """Закрывает соединение и освобождает место на сервере"""
+        try:
+            if self.connection is not None:
+                self.connection.close()
+        finally:
+            self.connection = None
+            if self.relay is not None:
+                self.relays.release(self.relay)
+                self.relay = None
+
+    def reconnect(self):
+        """Пересоздает соединение с тем же сервером"""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.open()
+
+    def _deliver(self, message):
+        if isinstance(message, EmailMessage):
+            return self.connection.send_messages([message])
+        # письмо из шаблона рассылки уже сериализовано, отправляем его без повторной сборки MIME;
+        # отказы сервера по отдельным получателям остаются в message.refused
+        recipients = message.recipients()
+        message.refused = self.connection.connection.sendmail(message.from_email, recipients, message.data)
+        return len(recipients) - len(message.refused)
+
+    def _send(self, message):
+        self.open()
+        rate_limiter.acquire(relay=self.relay.name, tokens=len(message.recipients()))
+        try:
+            return self._deliver(message)
+        except SMTPServerDisconnected:
+            self.reconnect()
+            return self._deliver(message)
+
+    def send(self, message):
+        """Отправляет письмо (EmailMessage или PreparedMessage) через открытое соединение,
+        возвращает количество получателей, которым письмо принято сервером"""
+        tried, error = [], None
+        if self.connection is not None and self.sent_on_connection >= self.max_messages:
+            # соединение пересоздается, и сервер для него выбирается заново
+            self.close()
+        while True:
+            if self.relay is None:
+                self.relay = self.relays.acquire(exclude=tried)
+                if self.relay is None:
+                    raise error or self.relays.get_open_error()
+            relay = self.relay
+            try:
+                with relay.breaker.guard():
+                    sent = self._send(message)
+            except CircuitOpenError:
+                # пока ждали пробное письмо, предохранитель сервера снова открылся
+                pass
+            except Exception as exc:
+                self.relays.count(relay, 'failed')
+                if not is_transport_error(exc):
+                    raise
+                error = exc
+            else:
+                self.relays.count(relay, 'sent')
+                self.sent_on_connection += 1
+                return sent
+            # сервер недоступен: закрываем соединение и отправляем письмо через следующий сервер
+            self.relays.count(relay, 'failovers')
+            tried.append(relay)
+            with suppress(OSError):
+                self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        self.relays.publish()
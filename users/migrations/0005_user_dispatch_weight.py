@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 12:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_alter_user_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='dispatch_weight',
+            field=models.PositiveSmallIntegerField(default=1, verbose_name='Вес при отправке рассылок'),
+        ),
+    ]
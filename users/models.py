@@ -12,6 +12,7 @@ class User(AbstractUser):
     country = models.CharField(max_length=100, **NULLABLE, verbose_name='Страна')
 
     token = models.CharField(max_length=100, verbose_name='Токен', **NULLABLE)
+    dispatch_weight = models.PositiveSmallIntegerField(default=1, verbose_name='Вес при отправке рассылок')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []